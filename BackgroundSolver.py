@@ -0,0 +1,257 @@
+import os
+import pickle
+import queue
+import subprocess
+import sys
+import threading
+from collections import OrderedDict
+
+from Utils import *
+from GameState import GameState, LevelLoader, level_problems
+from Simulation import Action, step, reset_level
+from Solver import solve
+
+# Runs the solver in a separate process, so that a game or editor can ask for solutions without pausing.
+# Only one search runs at a time: a new request cancels the one in progress, as the answer to it is no
+# longer wanted. Answers are cached, hints along with the rest of the solution they found, so asking again
+# anywhere on a known path is instant.
+#
+# The worker is this file run as a script. Requests and answers are pickled tuples over its stdin and stdout:
+#   ('solve', request id, level number, state parts, time limit, max states) -> (request id, status, action values)
+#   ('check', request id, level string, time limit, max states) -> (request id, problems, status, solution length)
+#   ('deadlock', request id, level number, state parts, time limit, max states) -> (request id, deadlocked)
+#   ('cancel',) stops the search in progress, ('close',) (or closing stdin) stops the worker.
+# States are sent as their parts (see state_parts) and rebuilt from the level in the worker.
+
+HINT_CACHE_SIZE = 10000 # States kept by BackgroundSolver
+CHECK_CACHE_SIZE = 100 # Level strings kept by BackgroundSolver
+DEADLOCK_CACHE_SIZE = 10000 # States kept by BackgroundSolver
+DEFAULT_TIME_LIMIT = 30
+
+def state_parts(state):
+    # The parts of a state that change while playing a level.
+    blocks = dict((block_key, list(positions)) for block_key, positions in state.blocks.items())
+    return (state.player_position, state.tape_end_position, state.player_direction, state.player_orientation, blocks)
+
+def state_from_parts(starting_state, parts):
+    # Rebuild a state from state_parts, given the starting state of its level.
+    player_position, tape_end_position, player_direction, player_orientation, blocks = parts
+    state = reset_level(starting_state)
+    state.player_position = player_position
+    state.tape_end_position = tape_end_position
+    state.player_direction = player_direction
+    state.player_orientation = player_orientation
+    moved_blocks = dict((block_key, blocks.get(block_key, [])) for block_key in set(state.blocks) | set(blocks))
+    state.replace_blocks(moved_blocks)
+    return state
+
+def read_messages(file, messages):
+    # Reader thread, unpickles messages onto a queue. None marks the end of the stream.
+    try:
+        while True:
+            messages.put(pickle.load(file))
+    except (EOFError, OSError, pickle.UnpicklingError):
+        messages.put(None)
+
+def send_message(file, message):
+    pickle.dump(message, file)
+    file.flush()
+
+class Hint:
+    # The answer for one state: the solver status, and the next action if it was solved.
+    # action is None when the state is already at the goal or there's no solution.
+
+    def __init__(self, status, action):
+        self.status = status
+        self.action = action
+
+class LevelCheck:
+    # The verdict on a level string: the mistakes found in it (see GameState.level_problems), and if there were
+    # none, the solver status and the length of the shortest solution (None unless it was solved).
+
+    def __init__(self, problems, status, solution_length):
+        self.problems = problems
+        self.status = status
+        self.solution_length = solution_length
+
+class DeadlockCheck:
+    # Whether the goal can no longer be reached from a state with no blocks left, see GameState.is_deadlocked_without_blocks.
+
+    def __init__(self, deadlocked):
+        self.deadlocked = deadlocked
+
+class BackgroundSolver:
+
+    def __init__(self, levels_file, time_limit=DEFAULT_TIME_LIMIT, max_states=None):
+        self.time_limit = time_limit
+        self.max_states = max_states
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), levels_file], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.results = queue.Queue()
+        threading.Thread(target=read_messages, args=(self.process.stdout, self.results), daemon=True).start()
+        self.hints = OrderedDict() # (level number, state key) -> Hint
+        self.checks = OrderedDict() # level string -> LevelCheck
+        self.deadlocks = OrderedDict() # (level number, state key) -> DeadlockCheck
+        self.request_id = 0
+        self.failed = False # Set once the worker has gone, after that nothing more is worked out
+        self.pending = None # (request id, request, state) of the search in progress, the request is as sent minus its id and limits
+
+    def hint(self, level_no, state):
+        # The Hint for the state if it's known, otherwise starts working it out and returns None (see poll).
+        # Cancels any search in progress for another state.
+        key = (level_no, state.key())
+        if key in self.hints:
+            self.hints.move_to_end(key)
+            self.cancel()
+            return self.hints[key]
+        self.send_request(('solve', level_no, state_parts(state)), state)
+        return None
+
+    def check(self, level):
+        # The LevelCheck for a level string if it's known, otherwise starts working it out and returns None (see poll).
+        # Cancels any search in progress for anything else.
+        if level in self.checks:
+            self.checks.move_to_end(level)
+            self.cancel()
+            return self.checks[level]
+        self.send_request(('check', level))
+        return None
+
+    def deadlock(self, level_no, state):
+        # The DeadlockCheck for the state if it's known, otherwise starts working it out and returns None (see poll).
+        # The first check on a level builds its DeadlockTable in the worker, which can take a while.
+        key = (level_no, state.key())
+        if key in self.deadlocks:
+            self.deadlocks.move_to_end(key)
+            self.cancel()
+            return self.deadlocks[key]
+        self.send_request(('deadlock', level_no, state_parts(state)), state)
+        return None
+
+    def send_request(self, request, state=None):
+        # Ask the worker to start a search, unless it's already on it.
+        if self.failed or (self.pending is not None and self.pending[1] == request):
+            return
+        self.request_id += 1
+        self.pending = (self.request_id, request, state.clone() if state is not None else None)
+        self.send((request[0], self.request_id) + request[1:] + (self.time_limit, self.max_states))
+
+    def send(self, message):
+        try:
+            send_message(self.process.stdin, message)
+        except OSError:
+            self.worker_failed()
+
+    def worker_failed(self):
+        self.failed = True
+        self.pending = None
+
+    def poll(self):
+        # The Hint or LevelCheck for the last thing asked about once the search has finished, otherwise None.
+        while True:
+            try:
+                result = self.results.get_nowait()
+            except queue.Empty:
+                return None
+            if result is None:
+                # The worker has gone, nothing more is coming.
+                self.worker_failed()
+                return None
+            if self.pending is not None and result[0] == self.pending[0]:
+                request_id, request, state = self.pending
+                self.pending = None
+                if request[0] == 'check':
+                    return self.add_check(request[1], *result[1:])
+                if request[0] == 'deadlock':
+                    return self.add_deadlock(request[1], state, *result[1:])
+                return self.add_hints(request[1], state, *result[1:])
+
+    def add_hints(self, level_no, state, status, action_values):
+        # Cache the answer for the state, and for every state along the solution.
+        first_hint = Hint(status, Action(action_values[0]) if action_values else None)
+        self.cache_hint(level_no, state, first_hint)
+        if action_values:
+            state = state.clone()
+            for i, action_value in enumerate(action_values):
+                step(state, Action(action_value))
+                next_action = Action(action_values[i+1]) if i + 1 < len(action_values) else None
+                self.cache_hint(level_no, state, Hint(status, next_action))
+        return first_hint
+
+    def cache_hint(self, level_no, state, hint):
+        self.hints[(level_no, state.key())] = hint
+        if len(self.hints) > HINT_CACHE_SIZE:
+            self.hints.popitem(last=False)
+
+    def add_deadlock(self, level_no, state, deadlocked):
+        check = DeadlockCheck(deadlocked)
+        self.deadlocks[(level_no, state.key())] = check
+        if len(self.deadlocks) > DEADLOCK_CACHE_SIZE:
+            self.deadlocks.popitem(last=False)
+        return check
+
+    def add_check(self, level, problems, status, solution_length):
+        check = LevelCheck(problems, status, solution_length)
+        self.checks[level] = check
+        if len(self.checks) > CHECK_CACHE_SIZE:
+            self.checks.popitem(last=False)
+        return check
+
+    def cancel(self):
+        if self.pending is not None:
+            self.pending = None
+            self.send(('cancel',))
+
+    def close(self):
+        try:
+            send_message(self.process.stdin, ('close',))
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.wait()
+
+def run_worker(levels_file):
+    # Worker process loop, see the top of the file.
+    answers = sys.stdout.buffer
+    sys.stdout = sys.stderr # Anything printed must not end up in the answers
+    requests = queue.Queue()
+    reader = threading.Thread(target=read_messages, args=(sys.stdin.buffer, requests), daemon=True)
+    reader.start()
+    level_loader = None # Only loaded for hints and deadlocks, the editor just sends level strings
+    while True:
+        request = requests.get()
+        # Only the most recent request is still wanted.
+        while request is not None and request[0] != 'close' and not requests.empty():
+            request = requests.get()
+        if request is None or request[0] == 'close':
+            break
+        should_stop = lambda: not requests.empty()
+        if request[0] == 'solve':
+            request_id, level_no, parts, time_limit, max_states = request[1:]
+            if level_loader is None:
+                level_loader = LevelLoader(levels_file)
+            state = state_from_parts(level_loader.get_template(level_no), parts)
+            # The same level is searched again and again from different states, which is when pruning deadlocks pays.
+            result = solve(state, time_limit=time_limit, max_states=max_states, prune_deadlocks=True, should_stop=should_stop)
+            if result.status != 'cancelled':
+                send_message(answers, (request_id, result.status, [action.value for action in result.solution] if result.solution is not None else None))
+        elif request[0] == 'deadlock':
+            request_id, level_no, parts, time_limit, max_states = request[1:]
+            if level_loader is None:
+                level_loader = LevelLoader(levels_file)
+            # States rebuilt from the same template share its grid, so the level's DeadlockTable is kept between requests.
+            state = state_from_parts(level_loader.get_template(level_no), parts)
+            send_message(answers, (request_id, state.is_deadlocked_without_blocks()))
+        elif request[0] == 'check':
+            request_id, level, time_limit, max_states = request[1:]
+            problems = level_problems(level)
+            if problems:
+                send_message(answers, (request_id, problems, None, None))
+                continue
+            result = solve(GameState(level=level), time_limit=time_limit, max_states=max_states, should_stop=should_stop)
+            if result.status != 'cancelled':
+                send_message(answers, (request_id, problems, result.status, len(result.solution) if result.solution is not None else None))
+    # Wait for stdin to be closed, the reader thread mustn't be left reading it while Python shuts down.
+    reader.join()
+
+if __name__ == '__main__':
+    run_worker(sys.argv[1])
@@ -0,0 +1,271 @@
+import random
+
+from Utils import *
+from Simulation import Action, Event, step, reset_level, action_to_direction_map
+from TerrainArrays import numpy, terrain_arrays, lookup, tapes_fallen_off, sweep_offsets, sweep_valid, DIRECTIONS, direction_indices, NO_BLOCK
+
+# Steps many games of the same level at once, for training and evaluating bots.
+# The games are held as arrays with one row per game: player and tape end positions, facing direction
+# (an index into DIRECTIONS), orientation, and the offset of each block from where it starts in the
+# level along with whether it is still there. Blocks only ever move as a whole or fall off, so that
+# is all that's needed to know where every block square is.
+#
+# Turns, flips and tape moves that don't touch a block are worked out for every game at once with
+# array operations. Tape moves that touch a block (and so might push a chain of them) are played on a
+# GameState for just those games, so the rules are always exactly the same as GameState's.
+# differential_check plays random games on both to make sure of that. Needs NumPy.
+
+direction_vectors = numpy.array(DIRECTIONS)
+right_vectors = numpy.array([rotate_right(direction) for direction in DIRECTIONS])
+TURN_ACTIONS = [action for action in Action if action.name.startswith('FACE_')]
+
+class BatchSimulator:
+
+    def __init__(self, starting_state, batch_size):
+        self.starting_state = starting_state
+        self.batch_size = batch_size
+        self.terrain = terrain_arrays(starting_state)
+        self.block_keys = sorted(block_key for block_key, positions in starting_state.blocks.items() if positions)
+        self.block_starts = [list(starting_state.blocks[block_key]) for block_key in self.block_keys]
+        # Every block square at the start of the level, and the index of the block it belongs to.
+        self.block_squares = numpy.array([position for positions in self.block_starts for position in positions], dtype=numpy.int64).reshape((-1, 2))
+        self.square_blocks = numpy.array([i for i, positions in enumerate(self.block_starts) for position in positions], dtype=numpy.int64)
+        self.players = numpy.zeros((batch_size, 2), dtype=numpy.int64)
+        self.tape_ends = numpy.zeros((batch_size, 2), dtype=numpy.int64)
+        self.directions = numpy.zeros(batch_size, dtype=numpy.int64)
+        self.orientations = numpy.zeros(batch_size, dtype=numpy.int64)
+        self.block_offsets = numpy.zeros((batch_size, len(self.block_keys), 2), dtype=numpy.int64)
+        self.blocks_present = numpy.zeros((batch_size, len(self.block_keys)), dtype=bool)
+        # Block lookup table for each game, 0 for no block, otherwise the index of the block + 1.
+        self.block_labels = numpy.zeros((batch_size, starting_state.grid_width, starting_state.grid_height), dtype=numpy.uint8)
+        self.reset()
+
+    def reset(self, rows=None):
+        # Put the given games (default all) back to the start of the level.
+        rows = numpy.arange(self.batch_size) if rows is None else numpy.asarray(rows)
+        self.players[rows] = self.starting_state.player_position
+        self.tape_ends[rows] = self.starting_state.tape_end_position
+        self.directions[rows] = direction_indices[self.starting_state.player_direction]
+        self.orientations[rows] = self.starting_state.player_orientation
+        self.block_offsets[rows] = 0
+        self.blocks_present[rows] = True
+        self.update_block_labels(rows)
+
+    def update_block_labels(self, rows):
+        self.block_labels[rows] = NO_BLOCK
+        positions = self.block_squares[None] + self.block_offsets[rows][:,self.square_blocks]
+        present = self.blocks_present[rows][:,self.square_blocks]
+        batch = numpy.broadcast_to(rows[:,None], present.shape)
+        labels = numpy.broadcast_to(self.square_blocks + 1, present.shape)
+        self.block_labels[batch[present], positions[...,0][present], positions[...,1][present]] = labels[present]
+
+    def get_state(self, row):
+        # The game in the given row as a GameState.
+        state = reset_level(self.starting_state)
+        state.player_position = tuple(int(value) for value in self.players[row])
+        state.tape_end_position = tuple(int(value) for value in self.tape_ends[row])
+        state.player_direction = DIRECTIONS[self.directions[row]]
+        state.player_orientation = int(self.orientations[row])
+        moved_blocks = {}
+        for i, block_key in enumerate(self.block_keys):
+            offset_x, offset_y = self.block_offsets[row, i]
+            if not self.blocks_present[row, i]:
+                moved_blocks[block_key] = []
+            elif offset_x or offset_y:
+                moved_blocks[block_key] = [(x + int(offset_x), y + int(offset_y)) for x, y in self.block_starts[i]]
+        if moved_blocks:
+            state.replace_blocks(moved_blocks)
+        return state
+
+    def set_state(self, row, state):
+        # Copy a GameState of the same level into the given row.
+        self.players[row] = state.player_position
+        self.tape_ends[row] = state.tape_end_position
+        self.directions[row] = direction_indices[state.player_direction]
+        self.orientations[row] = state.player_orientation
+        for i, block_key in enumerate(self.block_keys):
+            positions = state.blocks.get(block_key)
+            self.blocks_present[row, i] = bool(positions)
+            if positions:
+                self.block_offsets[row, i] = vector_minus(positions[0], self.block_starts[i][0])
+        self.update_block_labels(numpy.array([row]))
+
+    def walls_at(self, positions):
+        return lookup(self.terrain.walls, positions[...,0], positions[...,1], False)
+
+    def blocks_at(self, rows, positions):
+        # Block label at each position, for the game in the matching row.
+        return lookup(self.block_labels[rows], positions[...,0], positions[...,1], NO_BLOCK)
+
+    def step(self, actions):
+        # Apply one action (an Action or its value) per game, in place.
+        # Returns a bool array indexed [row, Event value] of the events Simulation.step would report.
+        actions = numpy.array([getattr(action, 'value', action) for action in actions], dtype=numpy.int64)
+        before = (self.players.copy(), self.tape_ends.copy(), self.directions.copy(), self.orientations.copy(), self.block_offsets.copy(), self.blocks_present.copy())
+        needs_state = numpy.zeros(self.batch_size, dtype=bool)
+
+        rows = numpy.flatnonzero(actions == Action.EXTEND.value)
+        needs_state[rows[self.extend_tape(rows)]] = True
+        rows = numpy.flatnonzero(actions == Action.RETRACT.value)
+        needs_state[rows[self.retract_tape(rows)]] = True
+        self.switch_orientation(numpy.flatnonzero(actions == Action.FLIP.value))
+        for action in TURN_ACTIONS:
+            self.change_direction(numpy.flatnonzero(actions == action.value), direction_indices[action_to_direction_map[action]])
+
+        # Moves that touch blocks are played on a GameState.
+        for row in numpy.flatnonzero(needs_state):
+            state = self.get_state(row)
+            step(state, Action(actions[row]))
+            self.set_state(row, state)
+
+        events = numpy.zeros((self.batch_size, len(Event)), dtype=bool)
+        unchanged = numpy.ones(self.batch_size, dtype=bool)
+        for old, new in zip(before, (self.players, self.tape_ends, self.directions, self.orientations, self.block_offsets, self.blocks_present)):
+            unchanged &= (old == new).reshape((self.batch_size, -1)).all(axis=1)
+        events[:,Event.NO_EFFECT.value] = unchanged
+        events[:,Event.BLOCK_FELL.value] = self.blocks_present.sum(axis=1) < before[5].sum(axis=1)
+        goal_reached = (self.players == self.starting_state.goal_position).all(axis=1) & (self.tape_ends == self.starting_state.goal_position).all(axis=1)
+        events[:,Event.GOAL_REACHED.value] = goal_reached
+        events[:,Event.FELL_OFF.value] = ~goal_reached & tapes_fallen_off(self.terrain.supports, self.players, self.tape_ends)
+        return events
+
+    # The moves below follow the GameState methods of the same name, for the games in the given rows.
+    # extend_tape and retract_tape return a bool per row that is True where the move touches a block,
+    # those games are left as they were for step to play on a GameState.
+
+    def extend_tape(self, rows):
+        directions = direction_vectors[self.directions[rows]]
+        rights = right_vectors[self.directions[rows]] * self.orientations[rows,None]
+        players = self.players[rows]
+        tape_ends = self.tape_ends[rows]
+        tape_lengths = numpy.abs((tape_ends - players).sum(axis=1))
+        next_tape_ends = tape_ends + directions
+        against_wall = self.walls_at(next_tape_ends) | self.walls_at(next_tape_ends + rights)
+        touches_block = ~against_wall & ((self.blocks_at(rows, next_tape_ends) != NO_BLOCK) | (self.blocks_at(rows, next_tape_ends + rights) != NO_BLOCK))
+
+        # Against a wall, the player is pushed back until they hit a wall or the tape is at full length.
+        pushing = against_wall.copy()
+        next_players = players - directions
+        player_lengths = tape_lengths.copy()
+        for i in range(MAX_TAPE_LENGTH + 1):
+            hit_block = pushing & (self.blocks_at(rows, next_players) != NO_BLOCK)
+            touches_block |= hit_block
+            pushing &= ~hit_block & ~self.walls_at(next_players) & (player_lengths != MAX_TAPE_LENGTH)
+            if not pushing.any():
+                break
+            players[pushing] = next_players[pushing]
+            next_players[pushing] -= directions[pushing]
+            player_lengths += pushing
+
+        # Otherwise the tape extends until it hits a wall or is at full length.
+        extending = ~against_wall & ~touches_block
+        for i in range(MAX_TAPE_LENGTH + 1):
+            hit_block = extending & ((self.blocks_at(rows, next_tape_ends) != NO_BLOCK) | (self.blocks_at(rows, next_tape_ends + rights) != NO_BLOCK))
+            touches_block |= hit_block
+            extending &= ~hit_block & ~self.walls_at(next_tape_ends) & ~self.walls_at(next_tape_ends + rights) & (tape_lengths != MAX_TAPE_LENGTH)
+            if not extending.any():
+                break
+            tape_ends[extending] = next_tape_ends[extending]
+            next_tape_ends[extending] += directions[extending]
+            tape_lengths += extending
+
+        done = rows[~touches_block]
+        self.players[done] = players[~touches_block]
+        self.tape_ends[done] = tape_ends[~touches_block]
+        return touches_block
+
+    def retract_tape(self, rows):
+        directions = direction_vectors[self.directions[rows]]
+        rights = right_vectors[self.directions[rows]] * self.orientations[rows,None]
+        players = self.players[rows]
+        tape_ends = self.tape_ends[rows]
+        tape_lengths = numpy.abs((tape_ends - players).sum(axis=1))
+
+        # Hooked on a wall, the player is pulled to the tape end.
+        pulling = self.walls_at(tape_ends) | self.walls_at(tape_ends + rights)
+        touches_block = ~pulling & (self.blocks_at(rows, tape_ends + rights) != NO_BLOCK)
+        players[pulling] = tape_ends[pulling]
+
+        # Otherwise the tape comes back until it catches on a wall or reaches the player.
+        retracting = ~pulling & ~touches_block
+        for i in range(MAX_TAPE_LENGTH + 1):
+            hit_block = retracting & (self.blocks_at(rows, tape_ends + rights) != NO_BLOCK)
+            touches_block |= hit_block
+            retracting &= ~hit_block & ~self.walls_at(tape_ends) & ~self.walls_at(tape_ends + rights) & (tape_lengths != 0)
+            if not retracting.any():
+                break
+            tape_ends[retracting] -= directions[retracting]
+            tape_lengths -= retracting
+
+        done = rows[~touches_block]
+        self.players[done] = players[~touches_block]
+        self.tape_ends[done] = tape_ends[~touches_block]
+        return touches_block
+
+    def tape_edges_inside_wall_or_block(self, rows, tape_edges, directions):
+        # GameState.is_tape_edge_inside_wall_or_block for each row.
+        beyond = tape_edges + directions
+        edge_blocks = self.blocks_at(rows, tape_edges)
+        return (
+            (self.walls_at(tape_edges) & self.walls_at(beyond)) |
+            ((edge_blocks != NO_BLOCK) & (edge_blocks == self.blocks_at(rows, beyond)))
+        )
+
+    def switch_orientation(self, rows):
+        directions = direction_vectors[self.directions[rows]]
+        future_orientations = -self.orientations[rows]
+        tape_edges = self.tape_ends[rows] + right_vectors[self.directions[rows]] * future_orientations[:,None]
+        flipping = ~self.tape_edges_inside_wall_or_block(rows, tape_edges, directions)
+        self.orientations[rows[flipping]] = future_orientations[flipping]
+
+    def change_direction(self, rows, direction_index):
+        # Turning to face the way the player already faces (or the opposite way) does nothing.
+        rows = rows[(self.directions[rows] - direction_index) % 2 == 1]
+        direction = direction_vectors[direction_index]
+        right = right_vectors[direction_index]
+        players = self.players[rows]
+        tape_lengths = numpy.abs((self.tape_ends[rows] - players).sum(axis=1))
+        future_tape_ends = players + direction * tape_lengths[:,None]
+
+        # If the tape edge would end up inside a wall or block, try the other orientation.
+        stuck = self.tape_edges_inside_wall_or_block(rows, future_tape_ends + right * self.orientations[rows,None], direction)
+        stuck_both_ways = stuck & self.tape_edges_inside_wall_or_block(rows, future_tape_ends - right * self.orientations[rows,None], direction)
+        flipped = rows[stuck & ~stuck_both_ways]
+        self.orientations[flipped] = -self.orientations[flipped]
+        rows = rows[~stuck_both_ways]
+        players = players[~stuck_both_ways]
+        tape_lengths = tape_lengths[~stuck_both_ways]
+        future_tape_ends = future_tape_ends[~stuck_both_ways]
+
+        # Then the turn is blocked by any wall or block square the tape sweeps through.
+        offsets = sweep_offsets[self.directions[rows], direction_index, tape_lengths + 1]
+        valid = sweep_valid[self.directions[rows], direction_index, tape_lengths + 1]
+        swept = players[:,None,:] + offsets
+        obstructed = ((self.walls_at(swept) | (self.blocks_at(rows, swept) != NO_BLOCK)) & valid).any(axis=1)
+        self.directions[rows[~obstructed]] = direction_index
+        self.tape_ends[rows[~obstructed]] = future_tape_ends[~obstructed]
+
+def differential_check(starting_state, batch_size, steps, seed=0):
+    # Plays the same random actions on a BatchSimulator and on GameStates and returns a list of
+    # (step, row, action) where they disagree. Games restart when they end, as in Simulation.Session.
+    rng = random.Random(seed)
+    batch = BatchSimulator(starting_state, batch_size)
+    states = [reset_level(starting_state) for row in range(batch_size)]
+    mismatches = []
+    for step_no in range(steps):
+        actions = [rng.choice(list(Action)) for row in range(batch_size)]
+        batch_events = batch.step(actions)
+        finished = []
+        for row, (state, action) in enumerate(zip(states, actions)):
+            state, events = step(state, action)
+            expected = numpy.zeros(len(Event), dtype=bool)
+            expected[[event.value for event in events]] = True
+            if batch.get_state(row) != state or (batch_events[row] != expected).any():
+                mismatches.append((step_no, row, action))
+                batch.set_state(row, state)
+            if Event.GOAL_REACHED in events or Event.FELL_OFF in events:
+                states[row] = reset_level(starting_state)
+                finished.append(row)
+        if finished:
+            batch.reset(finished)
+    return mismatches
@@ -0,0 +1,207 @@
+import multiprocessing
+import random
+from multiprocessing import shared_memory
+
+from Utils import *
+from GameState import LevelLoader
+from Simulation import Action, Event, step, reset_level
+from TerrainArrays import numpy, terrain_arrays
+
+# Reinforcement learning environments in the style of gym: reset() and step(action), with actions
+# numbered as in Simulation.Action and observations written into a preallocated NumPy buffer.
+# SubprocessVectorEnv runs many of them spread over worker processes, which write their observations
+# straight into shared memory. Needs NumPy, not pygame.
+#
+# An observation is a uint8 array indexed [plane, x, y] over the whole grid (border included), with a
+# plane for each of OBSERVATION_PLANES set to 1 on the squares it covers:
+#   wall, pit, goal: the terrain
+#   block: squares with a block on
+#   player, tape_end: where they are, the tape covers the squares between them
+#   tape_edge: the square the tape end hooks on, which shows the orientation
+#   facing: the square in front of the player, which shows the direction even when the tape is empty
+
+OBSERVATION_PLANES = ['wall', 'pit', 'goal', 'block', 'player', 'tape', 'tape_end', 'tape_edge', 'facing']
+plane_indices = dict((name, i) for i, name in enumerate(OBSERVATION_PLANES))
+STATIC_PLANES = 3 # wall, pit and goal only change with the level
+DEFAULT_MAX_STEPS = 500
+
+GOAL_REWARD = 1.0
+
+class TapeEscapeEnv:
+    # One game. Plays level_no, or a random level from the file on each reset if level_no is None.
+    # An episode ends when the goal is reached (reward GOAL_REWARD) or the player falls off, and is
+    # cut short after max_steps. step and reset return the same observation array every time,
+    # copy it to keep it. Pass observation to have it written into an existing array instead.
+
+    def __init__(self, levels_file='levels.ini', level_no=None, max_steps=DEFAULT_MAX_STEPS, seed=None, observation=None):
+        self.level_loader = LevelLoader(levels_file)
+        self.level_nos = [level_no] if level_no is not None else list(range(1, self.level_loader.level_count() + 1))
+        grid_sizes = set((template.grid_width, template.grid_height) for template in map(self.level_loader.get_template, self.level_nos))
+        if len(grid_sizes) != 1:
+            raise ValueError('Levels in {} are different sizes, pick one level'.format(levels_file))
+        grid_width, grid_height = grid_sizes.pop()
+        self.observation_shape = (len(OBSERVATION_PLANES), grid_width, grid_height)
+        self.observation = observation if observation is not None else numpy.zeros(self.observation_shape, dtype=numpy.uint8)
+        self.action_count = len(Action)
+        self.max_steps = max_steps
+        self.rng = random.Random(seed)
+        self.starting_state = None
+        self.state = None
+        self.level_no = None
+        self.steps = 0
+
+    def reset(self, seed=None):
+        # Start a new episode. Returns (observation, info).
+        if seed is not None:
+            self.rng.seed(seed)
+        level_no = self.rng.choice(self.level_nos)
+        if level_no != self.level_no:
+            self.level_no = level_no
+            self.starting_state = self.level_loader.load_new_level_state(level_no)
+            self.write_static_planes()
+        self.state = reset_level(self.starting_state)
+        self.steps = 0
+        self.write_dynamic_planes()
+        return self.observation, {'level_no': self.level_no}
+
+    def step(self, action):
+        # Returns (observation, reward, terminated, truncated, info), info['events'] holds the Simulation events.
+        self.state, events = step(self.state, Action(action))
+        self.steps += 1
+        self.write_dynamic_planes()
+        reward = GOAL_REWARD if Event.GOAL_REACHED in events else 0.0
+        terminated = Event.GOAL_REACHED in events or Event.FELL_OFF in events
+        truncated = not terminated and self.steps >= self.max_steps
+        return self.observation, reward, terminated, truncated, {'events': events, 'level_no': self.level_no}
+
+    def write_static_planes(self):
+        terrain = terrain_arrays(self.starting_state)
+        observation = self.observation
+        observation[plane_indices['wall']] = terrain.walls
+        observation[plane_indices['pit']] = terrain.pits
+        observation[plane_indices['goal']] = 0
+        observation[plane_indices['goal']][self.starting_state.goal_position] = 1
+
+    def write_dynamic_planes(self):
+        state = self.state
+        observation = self.observation
+        observation[STATIC_PLANES:] = 0
+        block_plane = observation[plane_indices['block']]
+        for positions in state.blocks.values():
+            for position in positions:
+                block_plane[position] = 1
+        observation[plane_indices['player']][state.player_position] = 1
+        observation[plane_indices['tape_end']][state.tape_end_position] = 1
+        (player_x, player_y), (tape_end_x, tape_end_y) = state.player_position, state.tape_end_position
+        observation[plane_indices['tape'], min(player_x, tape_end_x):max(player_x, tape_end_x) + 1, min(player_y, tape_end_y):max(player_y, tape_end_y) + 1] = 1
+        observation[plane_indices['tape_edge']][get_tape_edge_position(state.tape_end_position, state.player_direction, state.player_orientation)] = 1
+        observation[plane_indices['facing']][vector_add(state.player_position, state.player_direction)] = 1
+
+class SharedArrays:
+    # The arrays a SubprocessVectorEnv shares with its workers, all in one block of shared memory.
+    # Created by the main process, and attached to by name in the workers.
+
+    def __init__(self, env_count, observation_shape, name=None):
+        layout = [
+            ('observations', (env_count,) + tuple(observation_shape), numpy.uint8),
+            ('actions', (env_count,), numpy.int64),
+            ('rewards', (env_count,), numpy.float64),
+            ('terminated', (env_count,), numpy.bool_),
+            ('truncated', (env_count,), numpy.bool_),
+        ]
+        sizes = [int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize for field, shape, dtype in layout]
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=sum(sizes))
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        offset = 0
+        for (field, shape, dtype), size in zip(layout, sizes):
+            setattr(self, field, numpy.ndarray(shape, dtype=dtype, buffer=self.memory.buf, offset=offset))
+            offset += size
+
+    def close(self):
+        # Arrays over the buffer have to go before the buffer can be closed.
+        self.observations = self.actions = self.rewards = self.terminated = self.truncated = None
+        self.memory.close()
+
+def run_worker(connection, memory_name, env_count, observation_shape, first_env, env_args, seed):
+    # Worker process loop for SubprocessVectorEnv, runs the envs first_env onwards until told to close.
+    shared = SharedArrays(env_count, observation_shape, memory_name)
+    envs = []
+    for i in range(first_env, first_env + len(env_args)):
+        envs.append(TapeEscapeEnv(observation=shared.observations[i], seed=None if seed is None else seed + i, **env_args[i - first_env]))
+    infos = [None] * len(envs)
+    while True:
+        command = connection.recv()
+        if command == 'reset':
+            for j, env in enumerate(envs):
+                infos[j] = env.reset()[1]
+        elif command == 'step':
+            for j, env in enumerate(envs):
+                i = first_env + j
+                observation, reward, terminated, truncated, infos[j] = env.step(shared.actions[i])
+                shared.rewards[i] = reward
+                shared.terminated[i] = terminated
+                shared.truncated[i] = truncated
+                if terminated or truncated:
+                    # Start the next episode straight away, the observation is the first one of it.
+                    infos[j]['reset_info'] = env.reset()[1]
+        elif command == 'close':
+            break
+        connection.send(infos)
+    shared.close()
+    connection.close()
+
+class SubprocessVectorEnv:
+    # env_count TapeEscapeEnvs split between worker_count processes (default one per core).
+    # Takes an action per env and returns arrays with a row per env. Envs that finish an episode are
+    # reset straight away, so the observation returned for them is the start of the next one.
+    # The returned arrays live in shared memory and are overwritten by the next step or reset.
+    # Call close when finished with it.
+
+    def __init__(self, env_count, worker_count=None, seed=None, **env_args):
+        worker_count = min(env_count, worker_count or multiprocessing.cpu_count())
+        self.env_count = env_count
+        self.action_count = len(Action)
+        self.observation_shape = TapeEscapeEnv(**env_args).observation_shape
+        self.shared = SharedArrays(env_count, self.observation_shape)
+        self.connections = []
+        self.workers = []
+        for w in range(worker_count):
+            first_env = env_count * w // worker_count
+            last_env = env_count * (w + 1) // worker_count
+            connection, worker_connection = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=run_worker, args=(worker_connection, self.shared.memory.name, env_count, self.observation_shape, first_env, [env_args] * (last_env - first_env), seed), daemon=True)
+            worker.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.workers.append(worker)
+
+    def send(self, command):
+        # Tell every worker to do something and wait for them all, returns the infos of every env.
+        for connection in self.connections:
+            connection.send(command)
+        infos = []
+        for connection in self.connections:
+            infos.extend(connection.recv())
+        return infos
+
+    def reset(self):
+        # Returns (observations, infos).
+        infos = self.send('reset')
+        return self.shared.observations, infos
+
+    def step(self, actions):
+        # Returns (observations, rewards, terminated, truncated, infos).
+        self.shared.actions[:] = actions
+        infos = self.send('step')
+        return self.shared.observations, self.shared.rewards, self.shared.terminated, self.shared.truncated, infos
+
+    def close(self):
+        for connection in self.connections:
+            connection.send('close')
+            connection.close()
+        for worker in self.workers:
+            worker.join()
+        self.shared.close()
+        self.shared.memory.unlink()
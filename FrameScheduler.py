@@ -0,0 +1,36 @@
+import pygame
+
+DEFAULT_FPS = 60
+IDLE_TIMEOUT_MS = 1000
+
+class FrameScheduler:
+    # Paces a pygame loop. Frames are capped at fps, and when nothing is animating
+    # the loop sleeps until the next input event instead of spinning.
+    # Anything that needs frames without input (e.g. a flash) calls request_frame.
+
+    def __init__(self, fps=DEFAULT_FPS, idle_timeout=IDLE_TIMEOUT_MS):
+        self.clock = pygame.time.Clock()
+        self.fps = fps # 0 for no cap
+        self.idle_timeout = idle_timeout # Wake up this often even without events (ms)
+        self.frame_requested = True
+        self.exposed = False # Set when the window needs repainting, e.g. after being uncovered
+
+    def request_frame(self):
+        # Don't wait for an event before the next frame.
+        self.frame_requested = True
+
+    def tick(self):
+        # Wait long enough to keep to the frame cap.
+        self.clock.tick(self.fps)
+
+    def get_events(self):
+        # Use instead of pygame.event.get. Blocks until there is an event unless a frame was requested.
+        self.tick()
+        if self.frame_requested:
+            self.frame_requested = False
+            events = pygame.event.get()
+        else:
+            event = pygame.event.wait(self.idle_timeout)
+            events = ([event] if event.type != pygame.NOEVENT else []) + pygame.event.get()
+        self.exposed = any(event.type == pygame.VIDEOEXPOSE for event in events)
+        return events
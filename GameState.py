@@ -1,33 +1,326 @@
 import configparser
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+import hashlib
+from itertools import chain
+import os
 import re
+import struct
 
 from Utils import *
 
 DEFAULT_WIDTH=30
 DEFAULT_HEIGHT=20
 
+# Compiled levels are cached next to the levels file, see LevelLoader.
+# Cache file: header, then an index entry (and name) per level, then the compiled levels (see GameState.to_compiled).
+CACHE_SUFFIX = '.cache'
+CACHE_MAGIC = b'TELC'
+CACHE_VERSION = 1
+CACHE_HEADER_FORMAT = '<4sB8sqQI' # magic, version, content hash, mtime (ns) and size of the levels file, level count
+CACHE_INDEX_FORMAT = '<IIIH' # level number, offset, length, length of the name that follows
+COMPILED_LEVEL_FORMAT = '<7H' # grid width and height, player x and y, goal x and y, block count
+COMPILED_BLOCK_FORMAT = '<cH' # block key, number of squares that follow
+
+TEMPLATE_CACHE_SIZE = 16 # Parsed levels kept by each LevelLoader
+DEADLOCK_TABLE_COUNT = 8 # Levels kept in deadlock_tables
+
+tiletypes_by_value = dict((tiletype.value, tiletype) for tiletype in TileType)
+
 class LevelLoader:
     # Wraps around a config file and generates level states from it.
-
-    def __init__(self, levels_file):
-        self.config = configparser.ConfigParser()
-        self.config.read(levels_file)
+    # Levels are compiled into a binary cache file next to the config file the first time it's read,
+    # after that loading a level just unpacks it from the cache. The cache is rebuilt whenever the
+    # contents of the config file change.
+    # Nothing is parsed into a GameState until that level is asked for. The most recently used levels are
+    # kept as templates, and each call to load_new_level_state returns a clone of the template.
+
+    def __init__(self, levels_file, use_cache=True):
+        self.levels_file = levels_file
+        self.cache_file = levels_file + CACHE_SUFFIX
+        self._config = None
+        self.compiled_levels = None # level number -> compiled level
+        self.level_names = {}
+        self.templates = OrderedDict() # level number -> pristine starting state, least recently used first
+        if use_cache:
+            self.load_cache()
+
+    @property
+    def config(self):
+        # The parsed config file, only read if something asks for it.
+        if self._config is None:
+            self._config = configparser.ConfigParser()
+            self._config.read(self.levels_file)
+        return self._config
 
     def load_new_level_state(self, level_no):
-        return GameState(level=self.config['Levels'][str(level_no)])
+        return self.get_template(level_no).clone()
+
+    def get_template(self, level_no):
+        # The starting state of the level, don't change it.
+        if level_no in self.templates:
+            self.templates.move_to_end(level_no)
+            return self.templates[level_no]
+        if self.compiled_levels is not None:
+            template = from_compiled(self.compiled_levels[level_no])
+        else:
+            template = GameState(level=self.level_string(level_no))
+        self.templates[level_no] = template
+        if len(self.templates) > TEMPLATE_CACHE_SIZE:
+            self.templates.popitem(last=False)
+        return template
+
+    def level_string(self, level_no):
+        # The level as written in the config file, see GameState.serialize.
+        return self.config['Levels'][str(level_no)]
+
+    def level_count(self):
+        if self.compiled_levels is not None:
+            return len(self.compiled_levels)
+        return len(self.config['Levels'])
+
+    def level_name(self, level_no):
+        if self.compiled_levels is not None:
+            return self.level_names.get(level_no, '')
+        if not self.config.has_section('LevelNames'):
+            return ''
+        return self.config['LevelNames'].get(str(level_no), '')
+
+    def load_cache(self):
+        # Use the cache if it was built from the current levels file, otherwise build a new one.
+        # A cache that can't be read all the way through (e.g. cut short or corrupted) is rebuilt too.
+        try:
+            levels_stat = os.stat(self.levels_file)
+        except OSError:
+            return
+        try:
+            with open(self.cache_file, 'rb') as file:
+                cache_data = file.read()
+            magic, version, content_hash, mtime, size, level_count = struct.unpack_from(CACHE_HEADER_FORMAT, cache_data)
+            if magic != CACHE_MAGIC or version != CACHE_VERSION:
+                cache_data = None
+            elif (mtime, size) != (levels_stat.st_mtime_ns, levels_stat.st_size):
+                # The file has been touched, check whether the contents actually changed.
+                with open(self.levels_file, 'rb') as file:
+                    if levels_file_hash(file.read()) != content_hash:
+                        cache_data = None
+            if cache_data is not None:
+                self.read_cache(cache_data)
+                return
+        except (OSError, struct.error, ValueError):
+            pass
+        self.read_cache(self.build_cache(levels_stat))
+
+    def build_cache(self, levels_stat):
+        # Compile every level and write the cache file. Returns the cache contents.
+        with open(self.levels_file, 'rb') as file:
+            content_hash = levels_file_hash(file.read())
+        level_nos = sorted(int(level_no) for level_no in self.config['Levels'])
+        compiled_levels = [GameState(level=self.config['Levels'][str(level_no)]).to_compiled() for level_no in level_nos]
+        names = [self.level_name(level_no).encode('utf-8') for level_no in level_nos]
+        index_size = sum(struct.calcsize(CACHE_INDEX_FORMAT) + len(name) for name in names)
+        offset = struct.calcsize(CACHE_HEADER_FORMAT) + index_size
+        parts = [struct.pack(CACHE_HEADER_FORMAT, CACHE_MAGIC, CACHE_VERSION, content_hash, levels_stat.st_mtime_ns, levels_stat.st_size, len(level_nos))]
+        for level_no, compiled_level, name in zip(level_nos, compiled_levels, names):
+            parts.append(struct.pack(CACHE_INDEX_FORMAT, level_no, offset, len(compiled_level), len(name)))
+            parts.append(name)
+            offset += len(compiled_level)
+        parts.extend(compiled_levels)
+        cache_data = b''.join(parts)
+        # Write to a temporary file and rename it over the old cache, so the cache is never half written.
+        # The temporary file is named after the process, other processes (e.g. a BackgroundSolver) may be writing the cache too.
+        temp_file = '{}.{}.tmp'.format(self.cache_file, os.getpid())
+        try:
+            with open(temp_file, 'wb') as file:
+                file.write(cache_data)
+            os.replace(temp_file, self.cache_file)
+        except OSError as err:
+            print("Level cache write failed: "+str(err))
+        return cache_data
+
+    def read_cache(self, cache_data):
+        # Raises struct.error or ValueError (UnicodeDecodeError included) if the cache doesn't hold together.
+        level_count = struct.unpack_from(CACHE_HEADER_FORMAT, cache_data)[5]
+        position = struct.calcsize(CACHE_HEADER_FORMAT)
+        index_entry_size = struct.calcsize(CACHE_INDEX_FORMAT)
+        cache_view = memoryview(cache_data)
+        compiled_levels = {}
+        level_names = {}
+        for i in range(level_count):
+            level_no, offset, length, name_length = struct.unpack_from(CACHE_INDEX_FORMAT, cache_data, position)
+            position += index_entry_size
+            if position + name_length > len(cache_data) or offset + length > len(cache_data) or level_no in compiled_levels:
+                raise ValueError('Level cache index entry {} is out of bounds'.format(i))
+            if name_length:
+                level_names[level_no] = bytes(cache_view[position:position + name_length]).decode('utf-8')
+            position += name_length
+            compiled_levels[level_no] = cache_view[offset:offset + length]
+            check_compiled(compiled_levels[level_no])
+        self.compiled_levels = compiled_levels
+        self.level_names = level_names
+
+def levels_file_hash(contents):
+    return hashlib.blake2b(contents, digest_size=8).digest()
+
+def check_compiled(data):
+    # Raise struct.error or ValueError unless data is a whole compiled level that from_compiled can unpack.
+    grid_width, grid_height, player_x, player_y, goal_x, goal_y, block_count = struct.unpack_from(COMPILED_LEVEL_FORMAT, data)
+    position = struct.calcsize(COMPILED_LEVEL_FORMAT)
+    if not (player_x < grid_width and goal_x < grid_width and player_y < grid_height and goal_y < grid_height):
+        raise ValueError('Compiled level has the player or goal off the grid')
+    terrain = bytes(data[position:position + grid_width*grid_height])
+    if len(terrain) != grid_width*grid_height or not set(terrain) <= set(tiletypes_by_value):
+        raise ValueError('Compiled level has a bad terrain')
+    position += grid_width*grid_height
+    block_header_size = struct.calcsize(COMPILED_BLOCK_FORMAT)
+    for i in range(block_count):
+        block_key, square_count = struct.unpack_from(COMPILED_BLOCK_FORMAT, data, position)
+        position += block_header_size
+        coordinates = struct.unpack_from('<%dH' % (square_count*2), data, position)
+        position += square_count*4
+        block_key.decode()
+        if any(x >= grid_width for x in coordinates[0::2]) or any(y >= grid_height for y in coordinates[1::2]):
+            raise ValueError('Compiled level has a block off the grid')
+    if position != len(data):
+        raise ValueError('Compiled level is the wrong length')
+
+def from_compiled(data):
+    # Build a state from the output of GameState.to_compiled.
+    grid_width, grid_height, player_x, player_y, goal_x, goal_y, block_count = struct.unpack_from(COMPILED_LEVEL_FORMAT, data)
+    position = struct.calcsize(COMPILED_LEVEL_FORMAT)
+    state = GameState(width=grid_width - 2*GRID_BORDER, height=grid_height - 2*GRID_BORDER)
+    terrain = bytes(data[position:position + grid_width*grid_height])
+    position += grid_width*grid_height
+    state.grid = [list(map(tiletypes_by_value.__getitem__, terrain[x*grid_height:(x+1)*grid_height])) for x in range(grid_width)]
+    state.goal_position = (goal_x, goal_y)
+    block_header_size = struct.calcsize(COMPILED_BLOCK_FORMAT)
+    for i in range(block_count):
+        block_key, square_count = struct.unpack_from(COMPILED_BLOCK_FORMAT, data, position)
+        position += block_header_size
+        coordinates = struct.unpack_from('<%dH' % (square_count*2), data, position)
+        position += square_count*4
+        state.blocks[block_key.decode()] = list(zip(coordinates[0::2], coordinates[1::2]))
+    state.update_block_grid()
+    state._player_position = state._tape_end_position = (player_x, player_y)
+    state.zobrist_hash = state.compute_zobrist_hash()
+    return state
+
+def level_problems(level):
+    # Mistakes in a level string that stop it being played as drawn, as a list of messages (empty if there are none).
+    # Solvability is a separate question, see Solver.solve.
+    lines = level.splitlines()
+    problems = []
+    for symbol, name in [(tiletype_to_sym_map[TileType.PLAYER], 'player'), (tiletype_to_sym_map[TileType.GOAL], 'goal')]:
+        count = level.count(symbol)
+        if count != 1:
+            problems.append('{} {}s, needs 1'.format(count, name))
+    block_squares = defaultdict(set)
+    for y, line in enumerate(lines):
+        for x, tile in enumerate(line):
+            if tile.isalpha():
+                block_squares[tile.lower()].add((x, y))
+    for block_key in sorted(block_squares):
+        squares = block_squares[block_key]
+        # Blocks with the same letter move as one, so the squares must all join up.
+        start = next(iter(squares))
+        connected = {start}
+        to_visit = [start]
+        while to_visit:
+            x, y = to_visit.pop()
+            for neighbour in [(x, y-1), (x+1, y), (x, y+1), (x-1, y)]:
+                if neighbour in squares and neighbour not in connected:
+                    connected.add(neighbour)
+                    to_visit.append(neighbour)
+        if len(connected) != len(squares):
+            problems.append('block {} is in pieces'.format(block_key))
+        # Upper case squares have floor beneath and lower case have pit, a block needs floor under it somewhere
+        # or it has fallen off before the level starts.
+        if not any(lines[y][x].isupper() for x, y in squares):
+            problems.append('block {} has no floor beneath'.format(block_key))
+    return problems
+
+class DeadlockTable:
+    # Which positions without any blocks left can still reach the goal, for one level.
+    # With no blocks the only things that change are the player and tape, so there are few enough positions
+    # to search them all. Each position is searched the first time it's asked about, along with everything
+    # reachable from it, and the answers are kept for the rest of the level.
+
+    def __init__(self, state):
+        self.grid = state.grid # Kept so that deadlock_table can tell which terrain this is for
+        self.terrain_version = state.terrain_version
+        self.goal_position = state.goal_position
+        self.winnable = {} # GameState.key() -> whether the goal can be reached
+
+    def is_winnable(self, state):
+        key = state.key()
+        if key not in self.winnable:
+            self.explore(state)
+        return self.winnable[key]
+
+    def explore(self, state):
+        # Depth first search over the positions reachable from the state, then work back from the
+        # ones that reach the goal. Positions already in the table aren't searched again.
+        moves = [GameState.extend_tape, GameState.retract_tape, GameState.switch_orientation]
+        moves += [lambda state, direction=direction: state.change_direction(direction, collect_obstructions=False) for direction in [(0,-1), (1,0), (0,1), (-1,0)]]
+        states = {state.key(): state}
+        parents = defaultdict(list) # key -> keys of the positions that lead to it
+        winning = []
+        queue = [state]
+        while queue:
+            state = queue.pop()
+            key = state.key()
+            if state.goal_reached():
+                winning.append(key)
+                continue
+            for move in moves:
+                next_state = state.clone()
+                move(next_state)
+                if next_state.zobrist_hash == state.zobrist_hash:
+                    continue
+                if not next_state.goal_reached() and next_state.player_fallen_off():
+                    continue
+                next_key = next_state.key()
+                parents[next_key].append(key)
+                if next_key in self.winnable:
+                    if self.winnable[next_key]:
+                        winning.append(next_key)
+                elif next_key not in states:
+                    states[next_key] = next_state
+                    queue.append(next_state)
+        for key in states:
+            self.winnable[key] = False
+        while winning:
+            key = winning.pop()
+            self.winnable[key] = True
+            for parent_key in parents.pop(key, []):
+                if not self.winnable[parent_key]:
+                    winning.append(parent_key)
+
+deadlock_tables = OrderedDict()
+def deadlock_table(state):
+    # The DeadlockTable for the state's level, reused for as long as the terrain doesn't change.
+    key = id(state.grid)
+    table = deadlock_tables.get(key)
+    if table is None or table.grid is not state.grid or table.terrain_version != state.terrain_version or table.goal_position != state.goal_position:
+        table = DeadlockTable(state)
+        deadlock_tables[key] = table
+        if len(deadlock_tables) > DEADLOCK_TABLE_COUNT:
+            deadlock_tables.popitem(last=False)
+    deadlock_tables.move_to_end(key)
+    return table
 
 class GameState:
 
     def __init__(self, level='', width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT):
         # Border of width GRID_BORDER is added so that tape end cannot go out of bounds.
-        self.player_position = (GRID_BORDER, GRID_BORDER)
-        self.player_direction = (0,-1)
-        self.player_orientation = -1 # -1 for left, 1 for right
-        self.tape_end_position = (GRID_BORDER, GRID_BORDER)
+        self._player_position = (GRID_BORDER, GRID_BORDER)
+        self._player_direction = (0,-1)
+        self._player_orientation = -1 # -1 for left, 1 for right
+        self._tape_end_position = (GRID_BORDER, GRID_BORDER)
         self.circle_points = set() # TODO remove        
         self.blocks = defaultdict(list)
         self.force_win = False
+        self.push_cache = {} # See resolve_push
+        self.zobrist_hash = self.compute_zobrist_hash()
 
         if level != '':
             self.init_grid_from_serialised(level)
@@ -35,11 +328,108 @@ class GameState:
             self.init_blank_grid(width + 2*GRID_BORDER, height + 2*GRID_BORDER)
         
 
+    # Player and tape fields keep the zobrist hash up to date whenever they are assigned.
+    @property
+    def player_position(self):
+        return self._player_position
+
+    @player_position.setter
+    def player_position(self, position):
+        self.zobrist_hash ^= zobrist_value('player', self._player_position) ^ zobrist_value('player', position)
+        self._player_position = position
+
+    @property
+    def tape_end_position(self):
+        return self._tape_end_position
+
+    @tape_end_position.setter
+    def tape_end_position(self, position):
+        self.zobrist_hash ^= zobrist_value('tape', self._tape_end_position) ^ zobrist_value('tape', position)
+        self._tape_end_position = position
+
+    @property
+    def player_direction(self):
+        return self._player_direction
+
+    @player_direction.setter
+    def player_direction(self, direction):
+        self.zobrist_hash ^= zobrist_value('direction', self._player_direction) ^ zobrist_value('direction', direction)
+        self._player_direction = direction
+
+    @property
+    def player_orientation(self):
+        return self._player_orientation
+
+    @player_orientation.setter
+    def player_orientation(self, orientation):
+        self.zobrist_hash ^= zobrist_value('orientation', self._player_orientation) ^ zobrist_value('orientation', orientation)
+        self._player_orientation = orientation
+
+    def compute_zobrist_hash(self):
+        # Hash the state from scratch. Moves keep self.zobrist_hash updated incrementally instead.
+        zobrist_hash = (
+            zobrist_value('player', self._player_position) ^
+            zobrist_value('tape', self._tape_end_position) ^
+            zobrist_value('direction', self._player_direction) ^
+            zobrist_value('orientation', self._player_orientation)
+        )
+        for block_key, positions in self.blocks.items():
+            for position in positions:
+                zobrist_hash ^= zobrist_value('block', block_key, position)
+        return zobrist_hash
+
+    def key(self):
+        # Canonical immutable encoding of everything that can change while playing a level.
+        # Terrain is fixed for a level so it is not included; keys are only comparable between states of the same level.
+        parts = [struct.pack('<4H3b', *self._player_position, *self._tape_end_position, *self._player_direction, self._player_orientation)]
+        for block_key in sorted(self.blocks.keys()):
+            positions = sorted(self.blocks[block_key])
+            if positions:
+                parts.append(struct.pack('<cH', block_key.encode(), len(positions)))
+                parts.append(struct.pack('<%dH' % (len(positions)*2), *chain.from_iterable(positions)))
+        return b''.join(parts)
+
+    def __hash__(self):
+        return self.zobrist_hash
+
+    def __eq__(self, other):
+        if not isinstance(other, GameState):
+            return NotImplemented
+        return self.zobrist_hash == other.zobrist_hash and self.key() == other.key()
+
+    def clone(self):
+        # Cheap copy for restarting a level or branching a search.
+        # The terrain and block lookup table are shared with the copy until either side writes to them
+        # (see own_grid and own_block_grid), so only the player, tape and block positions are copied up front.
+        state = GameState.__new__(GameState)
+        state.__dict__.update(self.__dict__)
+        state.blocks = defaultdict(list, ((block_key, list(positions)) for block_key, positions in self.blocks.items()))
+        state.block_support_counts = dict(self.block_support_counts)
+        state.circle_points = set()
+        state.push_cache = {}
+        self.grid_shared = state.grid_shared = True
+        self.block_grid_shared = state.block_grid_shared = True
+        return state
+
+    def own_grid(self):
+        # Take a private copy of the terrain before changing it if it is shared with a clone.
+        if self.grid_shared:
+            self.grid = [column[:] for column in self.grid]
+            self.grid_shared = False
+
+    def own_block_grid(self):
+        # Take a private copy of the block lookup table before changing it if it is shared with a clone.
+        if self.block_grid_shared:
+            self.block_grid = [column[:] for column in self.block_grid]
+            self.block_grid_shared = False
+
     def init_blank_grid(self, width, height):
         # Build a blank grid of the given width and height
         self.grid_width = width
         self.grid_height = height
-        self.grid = [[TileType.PIT for y in range(self.grid_height)] for x in range(self.grid_width)]
+        self.grid = [[TileType.PIT] * self.grid_height for x in range(self.grid_width)]
+        self.grid_shared = False
+        self.terrain_version = 0 # Bumped on every terrain change so that renderers can cache the terrain
         self.goal_position = (self.grid_width-1, self.grid_height-1)
         self.update_block_grid()
 
@@ -51,113 +441,193 @@ class GameState:
             for x, tile in enumerate(line):
                 self.update_grid_square(x + GRID_BORDER, y + GRID_BORDER, tile)
 
+    def to_compiled(self):
+        # Pack the starting state of a level into bytes for the level cache (reverse of from_compiled).
+        # Only the things a level file can set are kept: the terrain, blocks, player and goal.
+        parts = [struct.pack(COMPILED_LEVEL_FORMAT, self.grid_width, self.grid_height, *self.player_position, *self.goal_position, len(self.blocks))]
+        parts.append(bytes(tiletype.value for column in self.grid for tiletype in column))
+        for block_key, positions in self.blocks.items():
+            parts.append(struct.pack(COMPILED_BLOCK_FORMAT, block_key.encode(), len(positions)))
+            parts.append(struct.pack('<%dH' % (len(positions)*2), *chain.from_iterable(positions)))
+        return b''.join(parts)
+
     def serialize(self):
         # Serialize the state down to a string representation (reverse of init_grid_from_serialized)
-        level_string = ''
+        # Symbols are collected in a list and joined once, adding to a string each time copies it.
+        symbols = []
         for y in range(GRID_BORDER, self.grid_height - GRID_BORDER):
             for x in range(GRID_BORDER, self.grid_width - GRID_BORDER):
                 if self.block_grid[x][y] != '':
                     if self.grid[x][y] == TileType.SPACE:
-                        level_string += self.block_grid[x][y].upper()
+                        symbols.append(self.block_grid[x][y].upper())
                     else:
-                        level_string += self.block_grid[x][y]
+                        symbols.append(self.block_grid[x][y])
                 elif self.player_position == (x,y):
-                    level_string += tiletype_to_sym_map[TileType.PLAYER]
+                    symbols.append(tiletype_to_sym_map[TileType.PLAYER])
                 elif self.goal_position == (x,y):
-                    level_string += tiletype_to_sym_map[TileType.GOAL]
+                    symbols.append(tiletype_to_sym_map[TileType.GOAL])
                 else:
-                    level_string += tiletype_to_sym_map[self.grid[x][y]]
-            level_string += '\n'
-        return level_string
+                    symbols.append(tiletype_to_sym_map[self.grid[x][y]])
+            symbols.append('\n')
+        return ''.join(symbols)
 
     def update_grid_square(self, x, y, tile):
         # blocks with the same alphabet letter move as a unit
         # upper case signifies a space beneath, lower case signifies a pit beneath
+        if re.match(r'[a-zA-Z]', tile) and self.block_grid[x][y] not in ('', tile.lower()):
+            # Painting one block over another takes the square from the old block
+            self.remove_block_square(self.block_grid[x][y], (x,y))
         if re.match(r'[A-Z]', tile):
-            self.blocks[tile.lower()].append((x,y))
-            self.grid[x][y] = TileType.SPACE
-            self.update_block_grid()
+            self.set_terrain(x, y, TileType.SPACE)
+            self.add_block_square(tile.lower(), (x,y))
         elif re.match(r'[a-z]', tile):
-            self.blocks[tile].append((x,y))
-            self.grid[x][y] = TileType.PIT
-            self.update_block_grid()
-        elif sym_to_tiletype_map[tile] == TileType.PLAYER:
-            if self.block_grid[x][y] != '':
-                # remove block (do this for other types too)
-                self.blocks[self.block_grid[x][y]].remove((x,y))
-                self.update_block_grid()
-            self.player_position = (x,y)
-            self.tape_end_position = (x,y)
-            self.grid[x][y] = TileType.SPACE
-        elif sym_to_tiletype_map[tile] == TileType.GOAL:
-            if self.block_grid[x][y] != '':
-                # remove block (do this for other types too)
-                self.blocks[self.block_grid[x][y]].remove((x,y))
-                self.update_block_grid()
-            self.goal_position = (x,y)
-            self.grid[x][y] = TileType.SPACE
+            self.set_terrain(x, y, TileType.PIT)
+            self.add_block_square(tile, (x,y))
         else:
             if self.block_grid[x][y] != '':
                 # remove block (do this for other types too)
-                self.blocks[self.block_grid[x][y]].remove((x,y))
-                self.update_block_grid()
-            self.grid[x][y] = sym_to_tiletype_map[tile]
+                self.remove_block_square(self.block_grid[x][y], (x,y))
+            if sym_to_tiletype_map[tile] == TileType.PLAYER:
+                self.player_position = (x,y)
+                self.tape_end_position = (x,y)
+                self.set_terrain(x, y, TileType.SPACE)
+            elif sym_to_tiletype_map[tile] == TileType.GOAL:
+                self.goal_position = (x,y)
+                self.set_terrain(x, y, TileType.SPACE)
+            else:
+                self.set_terrain(x, y, sym_to_tiletype_map[tile])
+
+    def set_terrain(self, x, y, tiletype):
+        # Change the static tile on a square, keeping the support count of any block on it correct.
+        block_key = self.block_grid[x][y]
+        if block_key != '':
+            self.block_support_counts[block_key] += (tiletype != TileType.PIT) - (self.grid[x][y] != TileType.PIT)
+        self.own_grid()
+        self.grid[x][y] = tiletype
+        self.terrain_version += 1
+        self.push_cache.clear()
+
+    def add_block_square(self, block_key, position):
+        # Add a square to a block, updating the block lookup table, support counts and hash.
+        if position in self.blocks[block_key]:
+            return
+        self.own_block_grid()
+        self.blocks[block_key].append(position)
+        self.block_grid[position[0]][position[1]] = block_key
+        self.block_support_counts[block_key] = self.block_support_counts.get(block_key, 0) + (self.grid[position[0]][position[1]] != TileType.PIT)
+        self.zobrist_hash ^= zobrist_value('block', block_key, position)
+        self.push_cache.clear()
+
+    def remove_block_square(self, block_key, position):
+        # Remove a square from a block, updating the block lookup table, support counts and hash.
+        self.own_block_grid()
+        self.blocks[block_key].remove(position)
+        self.block_grid[position[0]][position[1]] = ''
+        self.block_support_counts[block_key] -= self.grid[position[0]][position[1]] != TileType.PIT
+        self.zobrist_hash ^= zobrist_value('block', block_key, position)
+        self.push_cache.clear()
+
+    def replace_blocks(self, new_blocks):
+        # Move whole blocks to new squares, e.g. when undoing a move. new_blocks maps block keys to their
+        # new list of positions, an empty list removes the block. Only the squares involved are touched.
+        self.own_block_grid()
+        for block_key in new_blocks:
+            for position in self.blocks.get(block_key, []):
+                self.block_grid[position[0]][position[1]] = ''
+                self.zobrist_hash ^= zobrist_value('block', block_key, position)
+            self.blocks.pop(block_key, None)
+            self.block_support_counts.pop(block_key, None)
+        for block_key, positions in new_blocks.items():
+            if positions:
+                self.blocks[block_key] = list(positions)
+                self.block_support_counts[block_key] = 0
+                for position in positions:
+                    self.block_grid[position[0]][position[1]] = block_key
+                    self.zobrist_hash ^= zobrist_value('block', block_key, position)
+                    self.block_support_counts[block_key] += self.grid[position[0]][position[1]] != TileType.PIT
+        self.push_cache.clear()
 
     def update_block_grid(self):
-        # Reset the lookup table
-        self.block_grid = [['' for y in range(self.grid_height + 2*GRID_BORDER)] for x in range(self.grid_width + 2*GRID_BORDER)]
+        # Rebuild the block lookup table and support counts from scratch.
+        # Moves keep them up to date incrementally, this is only needed when self.blocks is replaced wholesale.
+        self.block_grid = [[''] * self.grid_height for x in range(self.grid_width)]
+        self.block_grid_shared = False
+        # Number of squares in each block that are not above a pit. A block with none has fallen off.
+        self.block_support_counts = {}
+        self.push_cache.clear()
         # Loop over blocks and store key in respective positions in lookup table
         for block_key in self.blocks.keys():
             positions = self.blocks[block_key]
+            self.block_support_counts[block_key] = 0
             for position in positions:
                 self.block_grid[position[0]][position[1]] = block_key
+                self.block_support_counts[block_key] += self.grid[position[0]][position[1]] != TileType.PIT
 
     def has_block_fallen_off(self, block_key):
         # Check if the given block has fallen off the game area
         # i.e. all positions are above pits
-        return all([self.grid[position[0]][position[1]] == TileType.PIT for position in self.blocks[block_key]])
+        return self.block_support_counts.get(block_key, 0) == 0
+
+    def resolve_push(self, block_key, direction):
+        # Work out in one pass which blocks move if the given block is pushed in the given direction.
+        # Returns the set of blocks in the push chain (the block itself and every block it shunts along)
+        # and whether any of them is obstructed by a wall or the player.
+        # Answers are cached until a block moves, as a move asks about the same chains many times.
+        cache_key = (block_key, direction, self.player_position)
+        if cache_key in self.push_cache:
+            return self.push_cache[cache_key]
+        chain = set([block_key])
+        blocks_to_check = [block_key]
+        obstructed = False
+        while blocks_to_check:
+            for position in self.blocks[blocks_to_check.pop()]:
+                new_position = (position[0] + direction[0], position[1] + direction[1])
+                if (
+                    self.grid[new_position[0]][new_position[1]] == TileType.WALL or
+                    self.player_position == new_position
+                ):
+                    # There's a wall or the player in the way.
+                    obstructed = True
+                new_pos_block_key = self.block_grid[new_position[0]][new_position[1]]
+                if new_pos_block_key != '' and new_pos_block_key not in chain:
+                    # There's another block in our path, it gets pushed too.
+                    chain.add(new_pos_block_key)
+                    blocks_to_check.append(new_pos_block_key)
+        result = (chain, obstructed)
+        self.push_cache[cache_key] = result
+        return result
 
     def block_can_move_one(self, block_key, direction):
         # Can the given block move in the given direction without obstruction?
-        # Move the positions in the block in the given direction and check if the resulting block
-        # overlaps with a wall.
-        # If it overlaps with another block, check that block can move too.
-        other_blocks_to_check = set()
-        for position in self.blocks[block_key]:
-            new_position = vector_add(position, direction)
-            new_pos_block_key = self.block_grid[new_position[0]][new_position[1]]
-            if (
-                self.grid[new_position[0]][new_position[1]] == TileType.WALL or
-                self.player_position == new_position
-            ):
-                # There's a wall or the player in the way.
-                return False
-            elif new_pos_block_key != block_key and new_pos_block_key != '':
-                # There's another block in our path, check that can move too.
-                other_blocks_to_check.add(new_pos_block_key)
-        # If we didn't find any walls in the way, check any adjacent blocks we found.
-        if not all(map(lambda x: self.block_can_move_one(x, direction), list(other_blocks_to_check))):
-            # At least one of the blocks couldn't move, so we can't move either.
-            return False
-        else:
-            return True
+        # Any blocks it would push must be able to move too.
+        return not self.resolve_push(block_key, direction)[1]
 
     def move_block_one(self, block_key, direction):
         # Move given block one square in the given direction.
         # Also move any others that are adjacent to this block.
-        new_block = []
-        other_blocks_moved = set()
-        for position in self.blocks[block_key]:
-            new_position = vector_add(position, direction)
-            new_pos_block_key = self.block_grid[new_position[0]][new_position[1]]
-            if new_pos_block_key != block_key and new_pos_block_key != '' and new_pos_block_key not in other_blocks_moved:
-                self.move_block_one(new_pos_block_key, direction)
-                other_blocks_moved.add(new_pos_block_key)
-            new_block.append(new_position)
-        self.blocks[block_key] = new_block
-        if self.has_block_fallen_off(block_key):
-            del self.blocks[block_key]
-        self.update_block_grid()
+        chain = self.resolve_push(block_key, direction)[0]
+        self.push_cache.clear()
+        self.own_block_grid()
+        # Update the lookup table only for the squares the blocks leave and enter.
+        for chain_block_key in chain:
+            for position in self.blocks[chain_block_key]:
+                self.block_grid[position[0]][position[1]] = ''
+                self.zobrist_hash ^= zobrist_value('block', chain_block_key, position)
+        for chain_block_key in chain:
+            new_block = [(position[0] + direction[0], position[1] + direction[1]) for position in self.blocks[chain_block_key]]
+            support_count = 0
+            for position in new_block:
+                self.block_grid[position[0]][position[1]] = chain_block_key
+                self.zobrist_hash ^= zobrist_value('block', chain_block_key, position)
+                support_count += self.grid[position[0]][position[1]] != TileType.PIT
+            self.blocks[chain_block_key] = new_block
+            self.block_support_counts[chain_block_key] = support_count
+            if self.has_block_fallen_off(chain_block_key):
+                for position in new_block:
+                    self.block_grid[position[0]][position[1]] = ''
+                    self.zobrist_hash ^= zobrist_value('block', chain_block_key, position)
+                del self.blocks[chain_block_key]
+                del self.block_support_counts[chain_block_key]
 
     def is_inside_grid(self, position):
         return position[0] > 0 and position[0] < self.grid_width and position[1] > 0 and position[1] < self.grid_height
@@ -383,9 +853,10 @@ class GameState:
 
             self.tape_end_position = current_tape_end_position
 
-    def change_direction(self, direction):
+    def change_direction(self, direction, collect_obstructions=True):
         # Changes the player_direction to 'direction', provided there are no obstructions
-        # Returns the list of obstruction coordinates or None if no obstructions found.
+        # Returns the set of obstruction coordinates or None if no obstructions found.
+        # If collect_obstructions is False, the set only holds the first obstruction found.
 
         # Skip if target direction is already the way we are facing or opposite the way we are facing (only 90 degree moves are valid)
         if self.player_direction == direction or self.player_direction == vector_scalar_multiply(direction, -1):
@@ -410,44 +881,26 @@ class GameState:
                 # Change player's orientation so they can rotate
                 self.player_orientation *= -1
 
-        # Scan across the bounding square whose sides are length t*2 where t = tape radius
-        # and for each point, if it is a wall and is within the circle traced by the tape
-        # it counts as an obstruction.
-        # The bounding square is split into four quadrants (nw, sw, ne, se) and move will be limited
-        # based on current direction and which quadrants contain an obstruction
-        obstructions = defaultdict(set)
-        self.circle_points = set()
-        for x in range(max(0, self.player_position[0] - tape_arc_radius), min(self.player_position[0] + 1, self.grid_width)):
-            for y in range(max(0, self.player_position[1] - tape_arc_radius), min(self.player_position[1] + 1, self.grid_height)):
-                # Check for obstructions in North West quadrant
-                if (self.grid[x][y] == TileType.WALL or self.block_grid[x][y] != '') and (x - self.player_position[0])**2 + (y - self.player_position[1])**2 < (tape_arc_radius)**2:
-                    obstructions[((-1,0),(0,-1))].add((x,y)) # west to north
-                    obstructions[((0,-1),(-1,0))].add((x,y)) # north to west
-            for y in range(self.player_position[1], min(self.player_position[1] + tape_arc_radius, self.grid_height)):
-                # Check for obstructions in South West quadrant
-                if (self.grid[x][y] == TileType.WALL or self.block_grid[x][y] != '') and (x - self.player_position[0])**2 + (y - self.player_position[1])**2 < (tape_arc_radius)**2:
-                    obstructions[((-1,0),(0,1))].add((x,y)) # west to south
-                    obstructions[((0,1),(-1,0))].add((x,y)) # south to west
-        for x in range(max(0, self.player_position[0]), min(self.player_position[0] + tape_arc_radius, self.grid_width)):
-            for y in range(max(0, self.player_position[1] - tape_arc_radius), min(self.player_position[1] + 1, self.grid_height)):
-                # Check for obstructions in North East quadrant
-                if (self.grid[x][y] == TileType.WALL or self.block_grid[x][y] != '') and (x - self.player_position[0])**2 + (y - self.player_position[1])**2 < (tape_arc_radius)**2:
-                    obstructions[((0,-1),(1,0))].add((x,y)) # north to east
-                    obstructions[((1,0),(0,-1))].add((x,y)) # east to north
-            for y in range(self.player_position[1], min(self.player_position[1] + tape_arc_radius, self.grid_height)):
-                # Check for obstructions in South East quadrant
-                if (self.grid[x][y] == TileType.WALL or self.block_grid[x][y] != '') and (x - self.player_position[0])**2 + (y - self.player_position[1])**2 < (tape_arc_radius)**2:
-                    obstructions[((0,1),(1,0))].add((x,y)) # south to east
-                    obstructions[((1,0),(0,1))].add((x,y)) # east to south
-
-        if (self.player_direction, direction) not in obstructions:
+        # Check the squares swept by the tape between the current and the new direction, using the
+        # precomputed offsets for this turn and tape length. Any wall or block there is an obstruction.
+        # Stop at the first one unless the caller wants all of them (e.g. to display them).
+        obstructions = set()
+        player_x, player_y = self.player_position
+        for offset_x, offset_y in rotation_sweep_offsets[(self.player_direction, direction)][tape_arc_radius]:
+            x = player_x + offset_x
+            y = player_y + offset_y
+            if 0 <= x < self.grid_width and 0 <= y < self.grid_height and (self.grid[x][y] == TileType.WALL or self.block_grid[x][y] != ''):
+                obstructions.add((x,y))
+                if not collect_obstructions:
+                    break
+
+        if not obstructions:
             # Intended rotation is not obstructed, update state.
             self.player_direction = direction
             self.tape_end_position = future_tape_end_position
-        else:
-            # Intended rotation is obstructed, return a set of the obstructions.
-            return obstructions[(self.player_direction, direction)]
-        return None
+            return None
+        # Intended rotation is obstructed, return a set of the obstructions.
+        return obstructions
 
     def switch_orientation(self):
         # Make sure that tape edge won't end up inside wall or block
@@ -460,6 +913,15 @@ class GameState:
         self.player_orientation = future_orientation
         return None
 
+    def is_deadlocked_without_blocks(self):
+        # True if no blocks are left and the goal can no longer be reached from here, whatever the player does
+        # (e.g. the blocks the level needed have all been pushed into pits). Positions with blocks in play are
+        # not decided and always return False, however stuck they are.
+        # The first call on a level searches every position reachable without blocks, see DeadlockTable.
+        if any(self.blocks.values()):
+            return False
+        return not deadlock_table(self).is_winnable(self)
+
     def goal_reached(self):
         force_win = self.force_win
         self.force_win = False
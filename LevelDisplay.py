@@ -1,5 +1,4 @@
 import pygame
-from time import sleep
 
 from Utils import *
 from GameState import GameState
@@ -16,6 +15,9 @@ LIGHT_GREEN =  51, 255, 153
 BROWN       = 204, 102,   0
 
 SCREEN_BORDER_THICKNESS = 0.01
+# A flash holds the last frame for FLASH_DELAY_MS, then shows the colour for FLASH_DURATION_MS.
+FLASH_DELAY_MS = 100
+FLASH_DURATION_MS = 200
 
 class LevelDisplay:
 
@@ -28,71 +30,126 @@ class LevelDisplay:
         self.y_offset = int(self.y_outer_offset + self.outer_height * SCREEN_BORDER_THICKNESS)
         self.obstruction_coords = set()
         self.debug_grid = False
-
-    def render_state(self, state):
-        # Work out how big the tiles should be to fit on the given screen size
-        tile_width = int(self.width/(state.grid_width - 2*GRID_BORDER))
-        tile_border = int(tile_width/8)
-        # Reset screen to black
-        self.screen.fill(BLACK)
-
-        # Draw a border around the display
-        border_offset = int((SCREEN_BORDER_THICKNESS * self.width)/2)
-        top_left = (self.x_outer_offset + border_offset, self.y_outer_offset + border_offset)
-        top_right = (self.x_outer_offset + (self.outer_width - border_offset), self.y_outer_offset + border_offset)
-        bottom_left = (self.x_outer_offset + border_offset, self.y_outer_offset + (self.outer_height - border_offset))
-        bottom_right = (self.x_outer_offset + (self.outer_width - border_offset), self.y_outer_offset + (self.outer_height - border_offset))
-        # pygame.draw.line(self.screen, LIGHT_GREY, top_left, top_right, border_offset*2)
-        # pygame.draw.line(self.screen, LIGHT_GREY, top_left, bottom_left, border_offset*2)
-        # pygame.draw.line(self.screen, LIGHT_GREY, bottom_left, bottom_right, border_offset*2)
-        # pygame.draw.line(self.screen, LIGHT_GREY, top_right, bottom_right, border_offset*2)
+        # Off-screen copy of the terrain, see get_terrain_surface
+        self.terrain_surface = None
+        self.terrain_grid = None
+        self.terrain_cache_key = None
+        # What was drawn over the terrain last time, so that only that needs to be redrawn.
+        self.dynamic_key = None
+        self.dynamic_rects = []
+        self.full_redraw = True
+        # See flash
+        self.flash_colour = None
+        self.flash_start_time = 0
+        self.flash_drawn = False
+
+    def invalidate(self):
+        # Make the next render_state redraw the whole screen, e.g. after something else has drawn over it.
+        self.full_redraw = True
+
+    def tile_rect(self, position, tile_width, tile_border):
+        return [self.x_offset + position[0] * tile_width - GRID_BORDER*tile_width + tile_border, self.y_offset + position[1] * tile_width - GRID_BORDER*tile_width + tile_border, tile_width - tile_border*2, tile_width - tile_border*2]
+
+    def get_terrain_surface(self, state, tile_width, tile_border):
+        # The floor, walls and goal pre-rendered to an off-screen surface the size of the screen.
+        # Terrain doesn't change while playing a level, so this is only redrawn when the level, its terrain
+        # (which the editor can change) or the tile size changes.
+        cache_key = (state.terrain_version, state.goal_position, tile_width, self.debug_grid)
+        if self.terrain_surface is not None and self.terrain_grid is state.grid and self.terrain_cache_key == cache_key:
+            return self.terrain_surface
+        self.terrain_surface = pygame.Surface(self.screen.get_size())
+        self.terrain_grid = state.grid
+        self.terrain_cache_key = cache_key
+        self.full_redraw = True
+        surface = self.terrain_surface
+        surface.fill(BLACK)
 
         # Draw the debug grid
         if self.debug_grid:
             for x in range(state.grid_width - 2*GRID_BORDER + 1):
-                pygame.draw.line(self.screen, RED, (self.x_offset + x*tile_width, self.y_offset), (self.x_offset + x*tile_width, self.y_offset + self.height))
+                pygame.draw.line(surface, RED, (self.x_offset + x*tile_width, self.y_offset), (self.x_offset + x*tile_width, self.y_offset + self.height))
             for y in range(state.grid_height - 2*GRID_BORDER + 1):
-                pygame.draw.line(self.screen, RED, (self.x_offset, self.y_offset + y*tile_width), (self.x_offset + self.width, self.y_offset + y*tile_width))
-        # Draw the grid and the static objects to the pygame screen
+                pygame.draw.line(surface, RED, (self.x_offset, self.y_offset + y*tile_width), (self.x_offset + self.width, self.y_offset + y*tile_width))
+        # Draw the grid and the static objects
         for x in range(GRID_BORDER, state.grid_width - GRID_BORDER):
             for y in range(GRID_BORDER, state.grid_height - GRID_BORDER):
                 tiletype = state.grid[x][y]
                 if tiletype == TileType.SPACE:
-                    self.screen.fill(DARK_GREY, [self.x_offset + x*tile_width - GRID_BORDER*tile_width + tile_border, self.y_offset + y * tile_width - GRID_BORDER*tile_width + tile_border, tile_width - tile_border*2, tile_width - tile_border*2], 0)              
+                    surface.fill(DARK_GREY, self.tile_rect((x, y), tile_width, tile_border), 0)
                 elif tiletype == TileType.WALL:
-                    self.screen.fill(LIGHT_GREY, [self.x_offset + x*tile_width - GRID_BORDER*tile_width + tile_border, self.y_offset + y * tile_width - GRID_BORDER*tile_width + tile_border, tile_width - tile_border*2, tile_width - tile_border*2], 0)
+                    surface.fill(LIGHT_GREY, self.tile_rect((x, y), tile_width, tile_border), 0)
                     # Filling in gaps between adjacent wall tiles.
                     if x < state.grid_width - 1 and state.grid[x+1][y] == TileType.WALL:
-                        self.screen.fill(LIGHT_GREY, [self.x_offset + (x + 1) * tile_width - GRID_BORDER*tile_width - tile_border, self.y_offset + y * tile_width - GRID_BORDER*tile_width + tile_border, tile_border*2, tile_width - tile_border*2], 0)
+                        surface.fill(LIGHT_GREY, [self.x_offset + (x + 1) * tile_width - GRID_BORDER*tile_width - tile_border, self.y_offset + y * tile_width - GRID_BORDER*tile_width + tile_border, tile_border*2, tile_width - tile_border*2], 0)
                     if y < state.grid_height - 1 and state.grid[x][y+1] == TileType.WALL:
-                        self.screen.fill(LIGHT_GREY, [self.x_offset + x * tile_width - GRID_BORDER*tile_width + tile_border, self.y_offset + (y + 1) * tile_width - GRID_BORDER*tile_width - tile_border, tile_width - tile_border*2, tile_border*2], 0)
+                        surface.fill(LIGHT_GREY, [self.x_offset + x * tile_width - GRID_BORDER*tile_width + tile_border, self.y_offset + (y + 1) * tile_width - GRID_BORDER*tile_width - tile_border, tile_width - tile_border*2, tile_border*2], 0)
 
         # Draw goal
-        self.screen.fill(LIGHT_GREEN, [self.x_offset + state.goal_position[0] * tile_width - GRID_BORDER*tile_width + tile_border, self.y_offset + state.goal_position[1] * tile_width - GRID_BORDER*tile_width + tile_border, tile_width - tile_border*2, tile_width - tile_border*2], 0)
+        surface.fill(LIGHT_GREEN, self.tile_rect(state.goal_position, tile_width, tile_border), 0)
+        return surface
+
+    def render_state(self, state):
+        # Draw the state and return the list of screen rectangles that changed, for pygame.display.update.
+        # Only the blocks, player, tape and obstructions are redrawn on top of the cached terrain,
+        # and nothing at all is drawn if none of them has changed since the last call.
+        if self.flash_colour is not None:
+            flash_rects = self.render_flash()
+            if self.flash_colour is not None:
+                return flash_rects
+        # Work out how big the tiles should be to fit on the given screen size
+        tile_width = int(self.width/(state.grid_width - 2*GRID_BORDER))
+        tile_border = int(tile_width/8)
+        terrain_surface = self.get_terrain_surface(state, tile_width, tile_border)
+
+        obstruction_coords = frozenset(self.obstruction_coords) if self.obstruction_coords is not None else frozenset()
+        dynamic_key = (state.key(), obstruction_coords)
+        if not self.full_redraw and dynamic_key == self.dynamic_key:
+            return []
+
+        if self.full_redraw:
+            # Reset screen to the terrain
+            self.screen.blit(terrain_surface, (0, 0))
+        else:
+            # Put the terrain back where the blocks and player were last drawn
+            for rect in self.dynamic_rects:
+                self.screen.blit(terrain_surface, rect, rect)
+        previous_rects = self.dynamic_rects
+        self.dynamic_rects = []
 
         # Draw blocks
         for block_key in state.blocks.keys():
+            block_rect = None
             for position in state.blocks[block_key]:
-                self.screen.fill(BROWN, [self.x_offset + position[0] * tile_width - GRID_BORDER*tile_width + tile_border, self.y_offset + position[1] * tile_width - GRID_BORDER*tile_width + tile_border, tile_width - tile_border*2, tile_width - tile_border*2], 0)
+                tile_rect = self.tile_rect(position, tile_width, tile_border)
+                self.screen.fill(BROWN, tile_rect, 0)
+                block_rect = pygame.Rect(tile_rect) if block_rect is None else block_rect.union(tile_rect)
                 if position[0] < state.grid_width - 1 and state.block_grid[position[0]+1][position[1]] == block_key:
                     self.screen.fill(BROWN, [self.x_offset + (position[0] + 1) * tile_width - GRID_BORDER*tile_width - tile_border, self.y_offset + position[1] * tile_width - GRID_BORDER*tile_width + tile_border, tile_border*2, tile_width - tile_border*2], 0)
                 if position[1] < state.grid_height - 1 and state.block_grid[position[0]][position[1]+1] == block_key:
                     self.screen.fill(BROWN, [self.x_offset + position[0] * tile_width - GRID_BORDER*tile_width + tile_border, self.y_offset + (position[1] + 1) * tile_width - GRID_BORDER*tile_width - tile_border, tile_width - tile_border*2, tile_border*2], 0)
+            if block_rect is not None:
+                self.dynamic_rects.append(block_rect)
 
         # Draw rotation obstructions
-        for x in range(state.grid_width):
-            for y in range(state.grid_height):
-                if self.obstruction_coords != None and (x, y) in self.obstruction_coords:
-                    self.screen.fill(RED, [self.x_offset + x * tile_width - GRID_BORDER*tile_width + tile_border, self.y_offset + y * tile_width - GRID_BORDER*tile_width + tile_border, tile_width - tile_border*2, tile_width - tile_border*2], 0)
+        for position in obstruction_coords:
+            tile_rect = self.tile_rect(position, tile_width, tile_border)
+            self.screen.fill(RED, tile_rect, 0)
+            self.dynamic_rects.append(pygame.Rect(tile_rect))
 
         # Draw player
         tape_end_centre = (self.x_offset + int(state.tape_end_position[0] * tile_width - GRID_BORDER*tile_width + tile_width/2) + (state.player_direction[0] * tile_width/2), self.y_offset + int(state.tape_end_position[1] * tile_width - GRID_BORDER*tile_width + tile_width/2) + (state.player_direction[1] * tile_width/2))
         tape_edge_offset = vector_scalar_multiply(rotate_right(state.player_direction), state.player_orientation * tile_width * 0.66) 
         tape_edge = vector_add(tape_end_centre, tape_edge_offset)
         player_screen_position = (self.x_offset + int(state.player_position[0] * tile_width - GRID_BORDER*tile_width + tile_width/2), self.y_offset + int(state.player_position[1] * tile_width - GRID_BORDER*tile_width + tile_width/2))
-        pygame.draw.line(self.screen, YELLOW, tape_end_centre, player_screen_position, 2)
-        pygame.draw.line(self.screen, SILVER, tape_end_centre, tape_edge, 2)
-        pygame.draw.circle(self.screen, RED, player_screen_position, int(tile_width/2), 0)
+        self.dynamic_rects.append(pygame.draw.line(self.screen, YELLOW, tape_end_centre, player_screen_position, 2))
+        self.dynamic_rects.append(pygame.draw.line(self.screen, SILVER, tape_end_centre, tape_edge, 2))
+        self.dynamic_rects.append(pygame.draw.circle(self.screen, RED, player_screen_position, int(tile_width/2), 0))
+
+        self.dynamic_key = dynamic_key
+        if self.full_redraw:
+            self.full_redraw = False
+            return [self.screen.get_rect()]
+        return previous_rects + self.dynamic_rects
 
     def screen_position_to_grid_square(self, state, position):
         tile_width = int(self.width/(state.grid_width-2*GRID_BORDER))
@@ -103,10 +160,31 @@ class LevelDisplay:
             return None
 
     def flash(self, colour):
-        self.screen.fill(colour, [self.x_offset, self.y_offset, self.width, self.height])
-        sleep(0.1)
-        pygame.display.flip()
-        sleep(0.2)
+        # Start flashing the display area the given colour. The flash is drawn by render_state over the next
+        # few frames rather than waiting here, so keep rendering frames until is_flashing returns False.
+        self.flash_colour = colour
+        self.flash_start_time = pygame.time.get_ticks() + FLASH_DELAY_MS
+        self.flash_drawn = False
+
+    def is_flashing(self):
+        return self.flash_colour is not None
+
+    def render_flash(self):
+        # Draw the current stage of the flash, returns the changed screen rectangles.
+        now = pygame.time.get_ticks()
+        if now < self.flash_start_time:
+            return []
+        if now < self.flash_start_time + FLASH_DURATION_MS:
+            if self.flash_drawn:
+                return []
+            self.flash_drawn = True
+            flash_rect = pygame.Rect(self.x_offset, self.y_offset, self.width, self.height)
+            self.screen.fill(self.flash_colour, flash_rect)
+            return [flash_rect]
+        # Finished, everything underneath needs drawing again.
+        self.flash_colour = None
+        self.invalidate()
+        return []
 
     def flash_green(self):
         self.flash(LIGHT_GREEN)
@@ -0,0 +1,112 @@
+import pygame
+import time
+from collections import deque
+
+from LevelDisplay import BLACK, GREY, SILVER, RED, YELLOW, LIGHT_GREEN
+
+FRAME_HISTORY = 120 # Frames kept for the averages and the histogram
+ACTION_HISTORY = 20 # Timings kept per action
+HISTOGRAM_HEIGHT = 40
+PADDING = 4
+
+class PerfOverlay:
+    # Shows where the time goes in each frame, for tracking down stutters without a profiler.
+    # Each frame is split into phases with lap(), which records the time since the previous lap.
+    # Work that happens in the middle of other phases (e.g. history updates while handling input) is booked
+    # against its own phase with add_time(), and taken out of the phase it happened in.
+    # Input actions are timed separately with record_action().
+    # The overlay is drawn last, on an opaque panel in the bottom right corner of the screen.
+
+    def __init__(self, screen, font, frame_budget_ms):
+        self.screen = screen
+        self.font = font
+        self.frame_budget_ms = frame_budget_ms # Marked on the histogram, e.g. 1000/fps
+        self.enabled = False
+        self.phase_names = []
+        self.phase_times = {}
+        self.added_phases = [] # Phases timed with add_time, recorded once per frame by end_frame
+        self.added_times = {} # Seconds added to each of those so far this frame
+        self.frame_times = deque([], FRAME_HISTORY)
+        self.action_times = {}
+        self.frame_start = 0
+        self.lap_start = 0
+        self.rect = None # Where the overlay was last drawn
+
+    def toggle(self):
+        # Whatever was under the overlay needs redrawing by the caller when it's hidden.
+        self.enabled = not self.enabled
+        self.rect = None
+
+    def begin_frame(self):
+        self.frame_start = self.lap_start = time.perf_counter()
+
+    def lap(self, phase_name):
+        # Record the time since the last lap (or the start of the frame) against the given phase.
+        now = time.perf_counter()
+        if phase_name not in self.phase_times:
+            self.phase_names.append(phase_name)
+            self.phase_times[phase_name] = deque([], FRAME_HISTORY)
+        self.phase_times[phase_name].append((now - self.lap_start) * 1000)
+        self.lap_start = now
+
+    def add_time(self, phase_name, seconds):
+        # Book time already spent against a phase. It's left out of the current lap.
+        if phase_name not in self.phase_times:
+            self.phase_names.append(phase_name)
+            self.phase_times[phase_name] = deque([], FRAME_HISTORY)
+            self.added_phases.append(phase_name)
+        self.added_times[phase_name] = self.added_times.get(phase_name, 0) + seconds
+        self.lap_start += seconds
+
+    def end_frame(self):
+        self.frame_times.append((time.perf_counter() - self.frame_start) * 1000)
+        for phase_name in self.added_phases:
+            self.phase_times[phase_name].append(self.added_times.get(phase_name, 0) * 1000)
+        self.added_times.clear()
+
+    def record_action(self, action_name, seconds):
+        if action_name not in self.action_times:
+            self.action_times[action_name] = deque([], ACTION_HISTORY)
+        self.action_times[action_name].append(seconds * 1000)
+
+    def draw(self):
+        # Draw the overlay and return the screen rect it covers (for pygame.display.update), or None if hidden.
+        if not self.enabled:
+            return None
+        lines = []
+        if self.frame_times:
+            lines.append(('{:8.8s} avg {:5.2f} max {:5.2f} ms'.format('frame', sum(self.frame_times) / len(self.frame_times), max(self.frame_times)), SILVER))
+        for phase_name in self.phase_names:
+            times = self.phase_times[phase_name]
+            lines.append(('{:8.8s} avg {:5.2f} max {:5.2f} ms'.format(phase_name, sum(times) / len(times), max(times)), SILVER))
+        for action_name in sorted(self.action_times):
+            times = self.action_times[action_name]
+            lines.append(('{:14.14s} last {:5.2f} max {:5.2f}'.format(action_name, times[-1], max(times)), YELLOW))
+        surfaces = [self.font.render(text, True, colour) for text, colour in lines]
+
+        line_height = self.font.get_linesize()
+        width = max([surface.get_width() for surface in surfaces] + [FRAME_HISTORY]) + PADDING*2
+        height = line_height * len(surfaces) + HISTOGRAM_HEIGHT + PADDING*3
+        screen_width, screen_height = self.screen.get_size()
+        rect = pygame.Rect(screen_width - width, screen_height - height, width, height)
+        if self.rect is not None:
+            # Never shrink, so there's nothing left behind from the last frame to clean up.
+            rect = rect.union(self.rect)
+        self.screen.fill(BLACK, rect)
+        pygame.draw.rect(self.screen, GREY, rect, 1)
+        for i, surface in enumerate(surfaces):
+            self.screen.blit(surface, (rect.left + PADDING, rect.top + PADDING + i * line_height))
+
+        # Frame time histogram, one bar per frame with the newest on the right. Bars over budget are red.
+        # The scale tops out at twice the budget.
+        histogram_bottom = rect.bottom - PADDING
+        histogram_left = rect.right - PADDING - len(self.frame_times)
+        for i, frame_time in enumerate(self.frame_times):
+            bar_height = min(HISTOGRAM_HEIGHT, max(1, int(frame_time / (self.frame_budget_ms * 2) * HISTOGRAM_HEIGHT)))
+            colour = RED if frame_time > self.frame_budget_ms else LIGHT_GREEN
+            self.screen.fill(colour, [histogram_left + i, histogram_bottom - bar_height, 1, bar_height])
+        budget_y = histogram_bottom - HISTOGRAM_HEIGHT // 2
+        pygame.draw.line(self.screen, GREY, (rect.left + PADDING, budget_y), (rect.right - PADDING, budget_y))
+
+        self.rect = rect
+        return rect
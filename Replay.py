@@ -0,0 +1,197 @@
+import hashlib
+import struct
+
+from Utils import *
+from GameState import LevelLoader
+from StateHistory import StateHistory
+from Simulation import Action, step, load_level, reset_level
+
+# Compact recordings of a play session, and a headless player to re-simulate them.
+#
+# File layout:
+#   header: magic, format version, fingerprint of the levels file, starting level, undo history length
+#   then one byte per operation. Actions (see Simulation.Action) are stored as their value,
+#   the other operations are below. OP_LEVEL is followed by the level number.
+# Only turns that changed the state are recorded, the game tries to turn every frame.
+# OP_FRAME marks the end of a frame in which anything was recorded, that's when the game
+# checks whether the player has reached the goal or fallen off.
+
+MAGIC = b'TERP'
+VERSION = 1
+HEADER_FORMAT = '<4sB8sHH'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+LEVEL_FORMAT = '<H'
+LEVEL_SIZE = struct.calcsize(LEVEL_FORMAT)
+
+OP_RESTART = 0x80
+OP_UNDO = 0x81
+OP_REDO = 0x82
+OP_LEVEL = 0x83
+OP_FRAME = 0x84
+
+op_names = dict((action.value, action.name) for action in Action)
+op_names.update({OP_RESTART: 'RESTART', OP_UNDO: 'UNDO', OP_REDO: 'REDO', OP_LEVEL: 'LEVEL', OP_FRAME: 'FRAME'})
+
+CHECKPOINT_INTERVAL = 1000 # Operations between checkpoints kept by ReplayPlayer
+
+def levels_fingerprint(levels_file):
+    # Short hash of the levels file, a replay only makes sense with the levels it was recorded on.
+    with open(levels_file, 'rb') as file:
+        return hashlib.blake2b(file.read(), digest_size=8).digest()
+
+class ReplayRecorder:
+    # Writes a replay file as the game is played.
+
+    def __init__(self, filename, levels_file, level_no, history_length):
+        self.file = open(filename, 'wb')
+        self.file.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, levels_fingerprint(levels_file), level_no, history_length))
+        self.frame_has_ops = False
+
+    def record(self, op, level_no=None):
+        self.file.write(bytes([op]))
+        if op == OP_LEVEL:
+            self.file.write(struct.pack(LEVEL_FORMAT, level_no))
+        self.frame_has_ops = True
+
+    def record_action(self, action):
+        self.record(action.value)
+
+    def end_frame(self):
+        # Call once per frame, after the game has checked for the goal and falls.
+        if self.frame_has_ops:
+            self.file.write(bytes([OP_FRAME]))
+            self.file.flush()
+            self.frame_has_ops = False
+
+    def close(self):
+        self.end_frame()
+        self.file.close()
+
+class Replay:
+    # A replay file read back in, ops is a list of (op, level number or None).
+
+    def __init__(self, fingerprint, level_no, history_length, ops):
+        self.fingerprint = fingerprint
+        self.level_no = level_no
+        self.history_length = history_length
+        self.ops = ops
+
+def read_replay(filename):
+    with open(filename, 'rb') as file:
+        data = file.read()
+    if len(data) < HEADER_SIZE:
+        raise ValueError('Not a replay file: '+filename)
+    magic, version, fingerprint, level_no, history_length = struct.unpack_from(HEADER_FORMAT, data)
+    if magic != MAGIC:
+        raise ValueError('Not a replay file: '+filename)
+    if version != VERSION:
+        raise ValueError('Unsupported replay version {} in {}'.format(version, filename))
+    ops = []
+    i = HEADER_SIZE
+    while i < len(data):
+        op = data[i]
+        i += 1
+        if op == OP_LEVEL:
+            ops.append((op, struct.unpack_from(LEVEL_FORMAT, data, i)[0]))
+            i += LEVEL_SIZE
+        elif op in op_names:
+            ops.append((op, None))
+        else:
+            raise ValueError('Unknown replay op {} at byte {} in {}'.format(op, i - 1, filename))
+    return Replay(fingerprint, level_no, history_length, ops)
+
+class ReplayCheckpoint:
+    # Everything needed to carry on playing from an op index.
+
+    def __init__(self, index, player):
+        self.index = index
+        self.level_no = player.level_no
+        self.starting_state = player.starting_state
+        self.state = player.state.clone()
+        self.history = player.history.copy()
+        self.history_current = player.history.current is player.state
+        self.game_complete = player.game_complete
+
+class ReplayPlayer:
+    # Re-simulates a replay without a screen, as fast as possible.
+    # Follows the same rules as the input functions and main loop in tape-escape.py.
+    # A checkpoint is kept every checkpoint_interval ops so that seek can jump back quickly.
+
+    def __init__(self, replay, levels_file, checkpoint_interval=CHECKPOINT_INTERVAL, check_fingerprint=True):
+        if check_fingerprint and levels_fingerprint(levels_file) != replay.fingerprint:
+            raise ValueError('Replay was recorded with a different levels file than '+levels_file)
+        self.replay = replay
+        self.level_loader = LevelLoader(levels_file)
+        self.level_count = self.level_loader.level_count()
+        self.checkpoint_interval = checkpoint_interval
+        self.starting_states = {}
+        self.level_no = replay.level_no
+        self.starting_state = self.get_starting_state(self.level_no)
+        self.state = reset_level(self.starting_state)
+        self.history = StateHistory(replay.history_length)
+        self.history.add((self.state, self.level_no))
+        self.game_complete = False
+        self.index = 0 # Number of ops applied so far
+        self.checkpoints = [ReplayCheckpoint(0, self)]
+
+    def get_starting_state(self, level_no):
+        if level_no not in self.starting_states:
+            self.starting_states[level_no] = load_level(self.level_loader, level_no)
+        return self.starting_states[level_no]
+
+    def apply(self, op, level_no):
+        if self.game_complete:
+            return
+        if op < OP_RESTART:
+            step(self.state, Action(op))
+            if op in (Action.EXTEND.value, Action.RETRACT.value, Action.FLIP.value):
+                self.history.add((self.state, self.level_no))
+        elif op == OP_RESTART:
+            self.state = reset_level(self.starting_state)
+            self.history.add((self.state, self.level_no))
+        elif op == OP_UNDO:
+            self.state, self.level_no = self.history.back()
+        elif op == OP_REDO:
+            self.state, self.level_no = self.history.forward()
+        elif op == OP_LEVEL:
+            self.level_no = level_no
+            self.starting_state = self.get_starting_state(level_no)
+            self.state = reset_level(self.starting_state)
+            self.history.add((self.state, self.level_no))
+        elif op == OP_FRAME:
+            if self.state.goal_reached():
+                self.level_no += 1
+                if self.level_no <= self.level_count:
+                    self.starting_state = self.get_starting_state(self.level_no)
+                    self.state = reset_level(self.starting_state)
+                    self.history.forget_last_state()
+                else:
+                    self.game_complete = True
+            elif self.state.player_fallen_off():
+                self.state = reset_level(self.starting_state)
+
+    def run(self, until=None):
+        # Play forward to the given op index (default the end).
+        ops = self.replay.ops
+        until = len(ops) if until is None else min(until, len(ops))
+        while self.index < until:
+            op, level_no = ops[self.index]
+            self.apply(op, level_no)
+            self.index += 1
+            if self.index % self.checkpoint_interval == 0 and self.index > self.checkpoints[-1].index:
+                self.checkpoints.append(ReplayCheckpoint(self.index, self))
+
+    def seek(self, index):
+        # Jump to the given op index, restoring the nearest checkpoint first if that gets there sooner.
+        checkpoint = [checkpoint for checkpoint in self.checkpoints if checkpoint.index <= index][-1]
+        if index < self.index or checkpoint.index > self.index:
+            self.restore(checkpoint)
+        self.run(index)
+
+    def restore(self, checkpoint):
+        self.index = checkpoint.index
+        self.level_no = checkpoint.level_no
+        self.starting_state = checkpoint.starting_state
+        self.state = checkpoint.state.clone()
+        self.history = checkpoint.history.copy(self.state if checkpoint.history_current else None)
+        self.game_complete = checkpoint.game_complete
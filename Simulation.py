@@ -0,0 +1,95 @@
+from Utils import *
+from GameState import LevelLoader, GameState
+
+# The rules of the game as a plain step function, for anything that wants to play
+# without a screen (bots, solvers, replays, servers). Never import pygame here.
+
+class Action(Enum):
+    EXTEND = 0
+    RETRACT = 1
+    FLIP = 2
+    FACE_NORTH = 3
+    FACE_EAST = 4
+    FACE_SOUTH = 5
+    FACE_WEST = 6
+
+class Event(Enum):
+    NO_EFFECT = 0 # The action didn't change anything, e.g. the tape was blocked
+    BLOCK_FELL = 1 # A block was pushed off into a pit
+    GOAL_REACHED = 2
+    FELL_OFF = 3 # The player fell into a pit, the level needs restarting
+
+action_to_direction_map = {
+    Action.FACE_NORTH: (0,-1),
+    Action.FACE_EAST: (1,0),
+    Action.FACE_SOUTH: (0,1),
+    Action.FACE_WEST: (-1,0)
+}
+direction_to_action_map = dict((direction, action) for action, direction in action_to_direction_map.items())
+
+def step(state, action, obstructions=None):
+    # Apply the action to the state in place and return (state, events).
+    # If a set is passed as obstructions, the squares blocking a turn are added to it (e.g. to display them).
+    zobrist_hash = state.zobrist_hash
+    block_count = len(state.blocks)
+    if action == Action.EXTEND:
+        state.extend_tape()
+    elif action == Action.RETRACT:
+        state.retract_tape()
+    elif action == Action.FLIP:
+        state.switch_orientation()
+    else:
+        turn_obstructions = state.change_direction(action_to_direction_map[action], collect_obstructions=obstructions is not None)
+        if turn_obstructions is not None and obstructions is not None:
+            obstructions |= turn_obstructions
+    events = []
+    if state.zobrist_hash == zobrist_hash:
+        events.append(Event.NO_EFFECT)
+    if len(state.blocks) < block_count:
+        events.append(Event.BLOCK_FELL)
+    if state.goal_reached():
+        events.append(Event.GOAL_REACHED)
+    elif state.player_fallen_off():
+        events.append(Event.FELL_OFF)
+    return state, events
+
+def load_level(level_loader, level_no):
+    # Returns the starting state of a level, keep it around and use reset_level to play it.
+    return level_loader.load_new_level_state(level_no)
+
+def reset_level(starting_state):
+    # A fresh copy of the starting state to play, the starting state itself is left untouched.
+    return starting_state.clone()
+
+class Session:
+    # Plays through the levels of a levels file like the game does:
+    # falling off restarts the level, reaching the goal moves on to the next one.
+
+    def __init__(self, levels_file, level_no=1):
+        self.level_loader = LevelLoader(levels_file)
+        self.level_count = self.level_loader.level_count()
+        self.finished = False
+        self.load_level(level_no)
+
+    def load_level(self, level_no):
+        self.level_no = level_no
+        self.starting_state = load_level(self.level_loader, level_no)
+        self.state = reset_level(self.starting_state)
+
+    def restart(self):
+        self.state = reset_level(self.starting_state)
+
+    def step(self, action):
+        # Apply an action to the current level and return the events.
+        # The session has moved on to the next level (or restarted this one) by the time this returns.
+        if self.finished:
+            return [Event.NO_EFFECT]
+        state, events = step(self.state, action)
+        if Event.GOAL_REACHED in events:
+            if self.level_no < self.level_count:
+                self.load_level(self.level_no + 1)
+            else:
+                self.finished = True
+        elif Event.FELL_OFF in events:
+            self.restart()
+        return events
@@ -0,0 +1,62 @@
+from collections import deque
+import time
+
+from Utils import *
+from Simulation import Action, Event, step
+
+# Breadth-first search over the actions available to the player.
+# Used to find the shortest solution to a level without running the game client.
+
+class SolverResult:
+    # Outcome of a search: the shortest list of actions (or None) and how much work it took.
+
+    def __init__(self, status, solution, explored):
+        self.status = status # 'solved', 'unsolvable', 'timeout', 'state limit' or 'cancelled'
+        self.solution = solution # List of Actions
+        self.explored = explored
+
+def solve(starting_state, time_limit=None, max_states=None, prune_deadlocks=False, should_stop=None):
+    # Find the shortest sequence of actions that takes the player from the starting state to the goal.
+    # States where the player has fallen off are dead ends, as the game would restart the level.
+    # States hash by their zobrist hash, so they can be used directly as keys.
+    # With prune_deadlocks, states with no blocks left that can't win any more are dead ends too (see GameState.is_deadlocked_without_blocks).
+    # States with blocks in play are never pruned.
+    # Working that out searches every position without blocks once per level, which is as much as pruning
+    # can save in one search. It pays off when the same level is searched again from other states.
+    # should_stop is called between states, if it returns True the search is abandoned (e.g. the answer is no longer wanted).
+    start_time = time.monotonic()
+    # Maps each seen state to the state it was reached from and the action that got there.
+    parents = {starting_state: None}
+    queue = deque([starting_state])
+    if starting_state.goal_reached():
+        return SolverResult('solved', [], 1)
+    explored = 0
+    while queue:
+        state = queue.popleft()
+        explored += 1
+        if time_limit is not None and time.monotonic() - start_time > time_limit:
+            return SolverResult('timeout', None, explored)
+        if max_states is not None and len(parents) > max_states:
+            return SolverResult('state limit', None, explored)
+        if should_stop is not None and should_stop():
+            return SolverResult('cancelled', None, explored)
+        for action in Action:
+            next_state, events = step(state.clone(), action)
+            if Event.NO_EFFECT in events or next_state in parents:
+                continue
+            parents[next_state] = (state, action)
+            if Event.GOAL_REACHED in events:
+                return SolverResult('solved', trace_solution(parents, next_state), explored)
+            if Event.FELL_OFF in events or (prune_deadlocks and next_state.is_deadlocked_without_blocks()):
+                continue
+            queue.append(next_state)
+    return SolverResult('unsolvable', None, explored)
+
+def trace_solution(parents, state):
+    # Walk back through the parent links to recover the actions leading to the given state.
+    solution = []
+    while parents[state] is not None:
+        state, action = parents[state]
+        solution.append(action)
+    solution.reverse()
+    return solution
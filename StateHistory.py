@@ -1,7 +1,33 @@
 from Utils import *
 from GameState import GameState
 from collections import deque
-from copy import deepcopy
+from copy import copy
+
+# A full copy of the state is kept at least this often so that jumping back across
+# a level change only has to replay a bounded number of deltas.
+SNAPSHOT_INTERVAL = 20
+
+class HistoryEntry:
+    # One step in the history.
+    # fields holds the player and tape fields in full (they are tiny), block_changes holds
+    # {block_key: (old positions, new positions)} for the blocks that moved since the previous (older) entry.
+    # Entries that start a level have no block_changes (the terrain differs) and always carry a snapshot.
+
+    def __init__(self, level, fields, block_changes, snapshot, snapshot_distance):
+        self.level = level
+        self.fields = fields
+        self.block_changes = block_changes
+        self.snapshot = snapshot
+        self.snapshot_distance = snapshot_distance # Number of entries back to the nearest snapshot
+
+def get_fields(state):
+    return (state.player_position, state.tape_end_position, state.player_direction, state.player_orientation)
+
+def set_fields(state, fields):
+    state.player_position, state.tape_end_position, state.player_direction, state.player_orientation = fields
+
+def get_blocks(state):
+    return dict((block_key, tuple(positions)) for block_key, positions in state.blocks.items() if positions)
 
 class StateHistory:
     # Keeps a record of previous level states so that you can navigate
@@ -9,35 +35,139 @@ class StateHistory:
     # Also tracks where player is in the history so that player
     # can undo a sequence of moves and branch off without losing
     # history before that point.
+    # Steps are stored as reversible deltas and applied in place to the state being played,
+    # so the cost of a step scales with what changed rather than with the size of the level.
 
-    def __init__(self, memory_length):
+    def __init__(self, memory_length, snapshot_interval=SNAPSHOT_INTERVAL):
         self.memory = deque([], memory_length)
         self.active = 0
+        self.snapshot_interval = snapshot_interval
+        # The state object for the active entry (handed out by back/forward) and its block positions.
+        self.current = None
+        self.current_blocks = {}
 
     def add(self, state):
+        state, level = state
+        fields = get_fields(state)
+        blocks = get_blocks(state)
+        if len(self.memory) > 0:
+            active_entry = self.memory[self.active]
+            if active_entry.level == level and active_entry.fields == fields and self.current_blocks == blocks:
+                # Nothing changed (e.g. tape pushed against a wall), don't fill the history with duplicates.
+                self.current = state
+                return
         while self.active > 0:
             # Memory forward in time from the point we were at should be deleted
             self.memory.popleft()
             self.active -= 1
-        # print(self.to_string())        
-        self.memory.appendleft(deepcopy(state))
+        # print(self.to_string())
+
+        previous = self.memory[0] if len(self.memory) > 0 else None
+        if previous is None or previous.level != level or state is not self.current:
+            # New level or a replaced state object (e.g. restarting), the terrain may differ so store the whole state.
+            entry = HistoryEntry(level, fields, None, state.clone(), 0)
+        else:
+            block_changes = {}
+            for block_key in set(blocks) | set(self.current_blocks):
+                if blocks.get(block_key) != self.current_blocks.get(block_key):
+                    block_changes[block_key] = (self.current_blocks.get(block_key, ()), blocks.get(block_key, ()))
+            if previous.snapshot_distance + 1 >= self.snapshot_interval:
+                entry = HistoryEntry(level, fields, block_changes, state.clone(), 0)
+            else:
+                entry = HistoryEntry(level, fields, block_changes, None, previous.snapshot_distance + 1)
+
+        if len(self.memory) == self.memory.maxlen:
+            self.drop_oldest()
+        self.memory.appendleft(entry)
+        self.current = state
+        self.current_blocks = blocks
+
+    def drop_oldest(self):
+        # The oldest entry must always carry a snapshot. Before dropping it, roll its snapshot
+        # forward to the next entry if that one doesn't have its own.
+        oldest = self.memory.pop()
+        if len(self.memory) > 0 and self.memory[-1].snapshot is None:
+            next_oldest = self.memory[-1]
+            # Snapshots may be shared with copies of this history, so change a clone.
+            snapshot = oldest.snapshot.clone()
+            snapshot.replace_blocks(dict((block_key, new) for block_key, (old, new) in next_oldest.block_changes.items()))
+            set_fields(snapshot, next_oldest.fields)
+            next_oldest.snapshot = snapshot
+            next_oldest.snapshot_distance = 0
+
+    def reconstruct(self, index):
+        # Build a fresh state for the given entry from the nearest older snapshot.
+        snapshot_index = index
+        while self.memory[snapshot_index].snapshot is None:
+            snapshot_index += 1
+        state = self.memory[snapshot_index].snapshot.clone()
+        for i in range(snapshot_index - 1, index - 1, -1):
+            state.replace_blocks(dict((block_key, new) for block_key, (old, new) in self.memory[i].block_changes.items()))
+        set_fields(state, self.memory[index].fields)
+        self.current = state
+        self.current_blocks = get_blocks(state)
+
+    def step_to(self, index):
+        # Move the active entry to an adjacent index, changing the current state in place where possible.
+        if index == self.active:
+            # Nowhere to go, but put back the fields in case the state was turned since it was recorded.
+            if self.current is None:
+                self.reconstruct(index)
+            set_fields(self.current, self.memory[index].fields)
+            return
+        newer_entry = self.memory[min(index, self.active)]
+        if self.current is None or newer_entry.block_changes is None:
+            # Crossing a level boundary.
+            self.reconstruct(index)
+        else:
+            # Moving back applies the old positions of the newer entry, moving forward the new ones.
+            change_index = 0 if index > self.active else 1
+            new_blocks = dict((block_key, changes[change_index]) for block_key, changes in newer_entry.block_changes.items())
+            self.current.replace_blocks(new_blocks)
+            set_fields(self.current, self.memory[index].fields)
+            for block_key, positions in new_blocks.items():
+                if positions:
+                    self.current_blocks[block_key] = positions
+                else:
+                    self.current_blocks.pop(block_key, None)
+        self.active = index
 
     def back(self):
         if self.active < len(self.memory) - 1:
-            self.active += 1
+            self.step_to(self.active + 1)
+        else:
+            self.step_to(self.active)
         # print(self.to_string())
-        return deepcopy(self.memory[self.active])
+        return (self.current, self.memory[self.active].level)
 
     def forward(self):
         if self.active > 0:
-            self.active -= 1
-        # print(self.to_string())        
-        return deepcopy(self.memory[self.active])
+            self.step_to(self.active - 1)
+        else:
+            self.step_to(self.active)
+        # print(self.to_string())
+        return (self.current, self.memory[self.active].level)
+
+    def copy(self, current=None):
+        # An independent copy of the history, e.g. to go back to later. Snapshots are shared between the
+        # copies as they are never changed in place. current is the state object the copy should treat as the one
+        # being played (normally a clone of self.current), if None the copy rebuilds it when it is needed.
+        history = StateHistory(self.memory.maxlen, self.snapshot_interval)
+        history.memory = deque((copy(entry) for entry in self.memory), self.memory.maxlen)
+        history.active = self.active
+        history.current = current
+        history.current_blocks = dict(self.current_blocks)
+        return history
 
     def to_string(self):
-        mem_strings = map(lambda x: str(x.player_position)+','+str(x.tape_end_position), self.memory)
+        mem_strings = map(lambda x: str(x.fields[0])+','+str(x.fields[1]), self.memory)
         return ' : '.join(mem_strings)
 
     def forget_last_state(self):
         # forget last state
-        self.memory.popleft()
\ No newline at end of file
+        if self.active == 0 and len(self.memory) > 1:
+            self.step_to(1)
+            self.active = 0
+        elif self.active > 0:
+            self.active -= 1
+        self.memory.popleft()
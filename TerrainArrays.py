@@ -0,0 +1,145 @@
+from collections import OrderedDict
+
+from Utils import *
+
+try:
+    import numpy
+except ImportError:
+    # Only the analysis tools that use this module need NumPy, the game doesn't.
+    numpy = None
+
+# NumPy versions of the terrain and block layout of a GameState, for analysis jobs that ask the same
+# geometry questions about a lot of positions. Arrays are indexed [x, y] like GameState.grid, and the
+# list of lists on the GameState stays the real thing (LevelDisplay and the editor use it directly).
+#
+# The batch queries take arrays of positions (and optionally one block layout per position) and answer
+# for all of them at once. The single state versions are there for checking against GameState, for one
+# position the Python loops in GameState are quicker than the NumPy call overhead.
+
+DIRECTIONS = [(0,-1), (1,0), (0,1), (-1,0)]
+direction_indices = dict((direction, i) for i, direction in enumerate(DIRECTIONS))
+
+TERRAIN_CACHE_SIZE = 8 # Terrains kept by terrain_arrays
+NO_BLOCK = 0 # Label of squares without a block, blocks are labelled with the code of their letter
+
+def numpy_available():
+    return numpy is not None
+
+class TerrainArrays:
+    # Arrays for one terrain, get them with terrain_arrays(state) so that states sharing a grid share these too.
+
+    def __init__(self, state):
+        self.grid = state.grid # Kept so that the cache can tell which grid these are for
+        self.terrain_version = state.terrain_version
+        self.tiles = numpy.array([[tile.value for tile in column] for column in state.grid], dtype=numpy.uint8)
+        self.walls = self.tiles == TileType.WALL.value
+        self.pits = self.tiles == TileType.PIT.value
+        # Squares that stop the player falling, see GameState.player_fallen_off. The outer edge never does.
+        self.supports = ~self.pits
+        self.supports[0,:] = self.supports[:,0] = False
+
+terrain_cache = OrderedDict()
+def terrain_arrays(state):
+    # TerrainArrays for the state's terrain, reused for as long as the terrain doesn't change.
+    key = id(state.grid)
+    arrays = terrain_cache.get(key)
+    if arrays is None or arrays.grid is not state.grid or arrays.terrain_version != state.terrain_version:
+        arrays = TerrainArrays(state)
+        terrain_cache[key] = arrays
+        if len(terrain_cache) > TERRAIN_CACHE_SIZE:
+            terrain_cache.popitem(last=False)
+    terrain_cache.move_to_end(key)
+    return arrays
+
+def block_labels(state):
+    # The block layout as an array of block labels (see NO_BLOCK).
+    labels = numpy.zeros((state.grid_width, state.grid_height), dtype=numpy.uint8)
+    for block_key, positions in state.blocks.items():
+        if positions:
+            xs, ys = zip(*positions)
+            labels[list(xs), list(ys)] = ord(block_key)
+    return labels
+
+def block_key(label):
+    return chr(label)
+
+# Squares swept when turning, from rotation_sweep_offsets, padded out to the same length so that a whole
+# batch of turns can be looked up at once. Indexed [from direction, to direction, arc radius].
+# Turns that aren't 90 degrees have no squares.
+if numpy is not None:
+    sweep_length = max(len(offsets) for radii in rotation_sweep_offsets.values() for offsets in radii.values())
+    sweep_offsets = numpy.zeros((4, 4, MAX_TAPE_LENGTH + 2, sweep_length, 2), dtype=numpy.int64)
+    sweep_valid = numpy.zeros((4, 4, MAX_TAPE_LENGTH + 2, sweep_length), dtype=bool)
+    for (from_direction, to_direction), radii in rotation_sweep_offsets.items():
+        for radius, offsets in radii.items():
+            index = (direction_indices[from_direction], direction_indices[to_direction], radius)
+            sweep_offsets[index][:len(offsets)] = offsets
+            sweep_valid[index][:len(offsets)] = True
+
+def lookup(array, xs, ys, default):
+    # array[..., xs, ys] for a batch of positions, with default for positions outside the array.
+    # array is either one (width, height) array for all positions or one per position.
+    # xs and ys have the batch as their first dimension.
+    width, height = array.shape[-2:]
+    inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+    xs = numpy.clip(xs, 0, width - 1)
+    ys = numpy.clip(ys, 0, height - 1)
+    if array.ndim == 3:
+        batch = numpy.arange(len(xs)).reshape((-1,) + (1,) * (xs.ndim - 1))
+        values = array[batch, xs, ys]
+    else:
+        values = array[xs, ys]
+    return numpy.where(inside, values, default)
+
+def turns_obstructed(obstacles, players, from_directions, to_directions, tape_lengths):
+    # Whether any square swept by each turn is an obstruction, the sweep part of GameState.change_direction.
+    # obstacles is a bool array of walls and block squares, one for all turns or one per turn.
+    # players is an (n, 2) array of positions, directions are indices into DIRECTIONS.
+    offsets = sweep_offsets[from_directions, to_directions, tape_lengths + 1]
+    valid = sweep_valid[from_directions, to_directions, tape_lengths + 1]
+    xs = players[:,0,None] + offsets[:,:,0]
+    ys = players[:,1,None] + offsets[:,:,1]
+    return (lookup(obstacles, xs, ys, False) & valid).any(axis=1)
+
+def tapes_fallen_off(supports, players, tape_ends):
+    # GameState.player_fallen_off for a batch of (n, 2) player and tape end positions.
+    deltas = tape_ends - players
+    aligned = (deltas == 0).any(axis=1)
+    lengths = numpy.abs(deltas).sum(axis=1)
+    steps = numpy.arange(lengths.max() + 1 if len(lengths) else 1)
+    xs = players[:,0,None] + numpy.sign(deltas[:,0,None]) * steps
+    ys = players[:,1,None] + numpy.sign(deltas[:,1,None]) * steps
+    supported = lookup(supports, xs, ys, False) & (steps <= lengths[:,None])
+    return ~aligned | ~supported.any(axis=1)
+
+def fallen_block_mask(pits, labels):
+    # GameState.has_block_fallen_off for every block at once. labels is a (width, height) block layout or
+    # an (n, width, height) batch of them. Returns a bool array indexed [label] or [batch, label] that is
+    # True for blocks with every square above a pit.
+    batch_labels = labels.reshape((-1, labels.shape[-2] * labels.shape[-1])).astype(numpy.int64)
+    supported = numpy.broadcast_to(~pits.reshape((-1, pits.shape[-2] * pits.shape[-1])), batch_labels.shape)
+    batch_offsets = numpy.arange(len(batch_labels))[:,None] * 256
+    present = numpy.bincount((batch_labels + batch_offsets).ravel(), minlength=len(batch_labels) * 256)
+    held_up = numpy.bincount((batch_labels + batch_offsets)[supported], minlength=len(batch_labels) * 256)
+    fallen = ((present > 0) & (held_up == 0)).reshape((len(batch_labels), 256))
+    fallen[:,NO_BLOCK] = False
+    return fallen if labels.ndim == 3 else fallen[0]
+
+# The same queries for a single GameState.
+
+def obstacles(state):
+    return terrain_arrays(state).walls | (block_labels(state) != NO_BLOCK)
+
+def turn_obstructed(state, direction):
+    # Whether turning to face direction sweeps the tape through a wall or block. Turns that aren't
+    # 90 degrees count as unobstructed, change_direction ignores them.
+    tape_length = abs(sum(vector_minus(state.tape_end_position, state.player_position)))
+    return bool(turns_obstructed(obstacles(state), numpy.array([state.player_position]), numpy.array([direction_indices[state.player_direction]]), numpy.array([direction_indices[direction]]), numpy.array([tape_length]))[0])
+
+def player_fallen_off(state):
+    return bool(tapes_fallen_off(terrain_arrays(state).supports, numpy.array([state.player_position]), numpy.array([state.tape_end_position]))[0])
+
+def fallen_blocks(state):
+    # Keys of the blocks that have fallen off.
+    fallen = fallen_block_mask(terrain_arrays(state).pits, block_labels(state))
+    return set(block_key(label) for label in numpy.flatnonzero(fallen))
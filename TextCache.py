@@ -0,0 +1,30 @@
+import pygame
+from collections import OrderedDict
+
+DEFAULT_MAX_ENTRIES = 256
+
+class TextCache:
+    # Keeps rendered text surfaces so that the same string isn't rasterized again every frame.
+    # Keyed by (font, text, colour, antialias), the least recently used surface is dropped
+    # once there are more than max_entries.
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.surfaces = OrderedDict()
+
+    def render(self, font, text, colour, antialias=True):
+        # Same as font.render, but returns the cached surface if this text has been rendered before.
+        # The surface is shared, so don't draw on it.
+        cache_key = (font, text, tuple(colour), antialias)
+        surface = self.surfaces.get(cache_key)
+        if surface is not None:
+            self.surfaces.move_to_end(cache_key)
+            return surface
+        surface = font.render(text, antialias, colour)
+        self.surfaces[cache_key] = surface
+        if len(self.surfaces) > self.max_entries:
+            self.surfaces.popitem(last=False)
+        return surface
+
+    def clear(self):
+        self.surfaces.clear()
@@ -1,5 +1,6 @@
 import pdb
 from enum import Enum
+import hashlib
 
 # Constants and utilities needed by various modules in the game.
 
@@ -24,6 +25,21 @@ tiletype_to_sym_map = {}
 for k, v in sym_to_tiletype_map.items():
     tiletype_to_sym_map[v] = k
 
+# Squares swept by the tape when the player turns, relative to the player.
+# Keyed by (from direction, to direction) then by the radius of the arc (tape length + 1).
+# A square is swept if it lies in the quadrant between the two directions and inside the circle.
+# Squares are ordered nearest first.
+rotation_sweep_offsets = {}
+for from_direction in [(0,-1), (1,0), (0,1), (-1,0)]:
+    for to_direction in [(from_direction[1], from_direction[0]), (-from_direction[1], -from_direction[0])]:
+        x_sign = from_direction[0] + to_direction[0]
+        y_sign = from_direction[1] + to_direction[1]
+        rotation_sweep_offsets[(from_direction, to_direction)] = {}
+        for radius in range(1, MAX_TAPE_LENGTH + 2):
+            offsets = [(dx * x_sign, dy * y_sign) for dx in range(radius) for dy in range(radius) if dx**2 + dy**2 < radius**2]
+            offsets.sort(key=lambda offset: offset[0]**2 + offset[1]**2)
+            rotation_sweep_offsets[(from_direction, to_direction)][radius] = tuple(offsets)
+
 def vector_add(vec1, vec2):
     # Add two 2d tuples elementwise
     return tuple(sum(x) for x in zip(vec1, vec2))
@@ -43,4 +59,15 @@ def rotate_right(vec):
 def get_tape_edge_position(tape_end_position, direction, orientation):
     # Find the position of the tape edge (the hook coming out of the end of the tape) given the tape end, direction of player and orientation of tape.
     tape_edge_offset = vector_scalar_multiply(rotate_right(direction), orientation)
-    return vector_add(tape_end_position, tape_edge_offset)
\ No newline at end of file
+    return vector_add(tape_end_position, tape_edge_offset)
+
+zobrist_values = {}
+def zobrist_value(*parts):
+    # Fixed pseudo-random 64 bit value for a feature of a game state (e.g. a block letter on a square).
+    # Derived from the feature itself rather than a random generator so that hashes agree between runs and processes.
+    try:
+        return zobrist_values[parts]
+    except KeyError:
+        value = int.from_bytes(hashlib.blake2b(repr(parts).encode(), digest_size=8).digest(), 'little')
+        zobrist_values[parts] = value
+        return value
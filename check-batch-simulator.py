@@ -0,0 +1,29 @@
+import argparse
+import sys
+
+from GameState import LevelLoader
+from BatchSimulator import differential_check
+
+# Plays random games on BatchSimulator and on GameState for every level and reports any disagreement.
+# Run after changing the rules in either.
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Check that BatchSimulator plays the same as GameState.')
+    arg_parser.add_argument('-f', help='ini file containing levels', default='levels.ini')
+    arg_parser.add_argument('-n', help='Number of games to play at once per level', type=int, default=64)
+    arg_parser.add_argument('-s', help='Number of steps to play', type=int, default=500)
+    arg_parser.add_argument('--seed', help='Seed for the random actions', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    level_loader = LevelLoader(args.f)
+    failed = 0
+    for level_no in range(1, level_loader.level_count() + 1):
+        mismatches = differential_check(level_loader.load_new_level_state(level_no), args.n, args.s, args.seed + level_no)
+        print('Level {}: {} mismatches'.format(level_no, len(mismatches)))
+        for step_no, row, action in mismatches[:10]:
+            print('    step {} game {} {}'.format(step_no, row, action.name.lower()))
+        failed += bool(mismatches)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
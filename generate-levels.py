@@ -0,0 +1,148 @@
+import argparse
+import configparser
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+from Utils import *
+from GameState import GameState, DEFAULT_WIDTH, DEFAULT_HEIGHT
+from Solver import solve
+
+# Generates random levels and keeps the ones the solver can finish, for designers to pick through.
+# Each candidate is a few islands of floor in a sea of pits, with walls and blocks scattered around them
+# and the player and goal on different islands. Candidates are solved with a limited breadth-first search,
+# anything the search can't finish within the limits is thrown away, as are levels that are too short.
+# The survivors are written as a levels file like the editor's, shortest solutions first.
+
+DIRECTIONS = [(0,-1), (1,0), (0,1), (-1,0)]
+BLOCK_LETTERS = 'abcdef' # The editor can paint these
+MARGIN = 2 # Squares of pit left around the edge of the canvas
+BATCH_SIZE = 64 # Candidates handed to each worker at a time
+
+def random_level(rng, width, height):
+    # A candidate level as a level string (see GameState.serialize).
+    rows = [['.'] * width for y in range(height)]
+    def inside(x, y):
+        return MARGIN <= x < width - MARGIN and MARGIN <= y < height - MARGIN
+
+    # Islands of floor, each a short random walk. The first starts anywhere, the rest start a gap of pit away
+    # from one already made, close enough that the tape might reach across.
+    islands = []
+    for i in range(rng.randint(2, 4)):
+        if islands:
+            x, y = rng.choice(rng.choice(islands))
+            dx, dy = rng.choice(DIRECTIONS)
+            gap = rng.randint(2, MAX_TAPE_LENGTH)
+            x, y = x + dx * gap, y + dy * gap
+            if not inside(x, y):
+                continue
+        else:
+            x = rng.randrange(MARGIN, width - MARGIN)
+            y = rng.randrange(MARGIN, height - MARGIN)
+        island = []
+        for j in range(rng.randint(4, 25)):
+            if rows[y][x] == '.':
+                rows[y][x] = '*'
+                island.append((x, y))
+            dx, dy = rng.choice(DIRECTIONS)
+            if inside(x + dx, y + dy):
+                x, y = x + dx, y + dy
+        if island:
+            islands.append(island)
+    if len(islands) < 2:
+        return None
+    floor = [position for island in islands for position in island]
+
+    # Walls next to the floor, to push off and hook the tape on.
+    for i in range(rng.randint(2, 12)):
+        x, y = rng.choice(floor)
+        dx, dy = rng.choice(DIRECTIONS)
+        if inside(x + dx, y + dy) and rows[y + dy][x + dx] == '.':
+            rows[y + dy][x + dx] = '0'
+
+    # Blocks, rectangles on floor or pit next to the floor. Upper case for floor beneath, lower case for pit.
+    for letter in BLOCK_LETTERS[:rng.randint(0, 3)]:
+        block_width = rng.randint(1, 3)
+        block_height = rng.randint(1, 3)
+        left, top = rng.choice(floor)
+        squares = [(x, y) for x in range(left, left + block_width) for y in range(top, top + block_height)]
+        if all(inside(x, y) and rows[y][x] in '*.' for x, y in squares):
+            for x, y in squares:
+                rows[y][x] = letter.upper() if rows[y][x] == '*' else letter
+
+    # Player and goal on the floor of different islands.
+    player_island, goal_island = rng.sample(islands, 2)
+    free = lambda island: [(x, y) for x, y in island if rows[y][x] == '*']
+    if not free(player_island) or not free(goal_island):
+        return None
+    player_x, player_y = rng.choice(free(player_island))
+    goal_x, goal_y = rng.choice(free(goal_island))
+    rows[player_y][player_x] = '@'
+    rows[goal_y][goal_x] = '+'
+    return ''.join(''.join(row) + '\n' for row in rows)
+
+def generate(job):
+    # Run in the worker processes. Returns (seed, level string, solution length), with None for the
+    # level string if the candidate was rejected.
+    seed, width, height, min_length, max_states, time_limit = job
+    level = random_level(random.Random(seed), width, height)
+    if level is None:
+        return seed, None, 0
+    state = GameState(level=level)
+    result = solve(state, time_limit=time_limit, max_states=max_states)
+    if result.solution is None or len(result.solution) < min_length:
+        return seed, None, 0
+    # Write the level back out as the editor would, so the file looks the same as a hand made one.
+    return seed, state.serialize(), len(result.solution)
+
+def write_levels(filename, levels):
+    # levels is a list of (level string, name).
+    config = configparser.ConfigParser()
+    config.add_section('Levels')
+    config.add_section('LevelNames')
+    for i, (level, name) in enumerate(levels):
+        config.set('Levels', str(i+1), level)
+        config.set('LevelNames', str(i+1), name)
+    with open(filename, 'w') as file:
+        config.write(file)
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Generate random levels that the solver can finish.')
+    arg_parser.add_argument('-o', help='ini file to write the levels to', default='generated-levels.ini')
+    arg_parser.add_argument('-n', help='Number of levels to generate', type=int, default=100)
+    arg_parser.add_argument('-l', help='Minimum solution length in moves', type=int, default=10)
+    arg_parser.add_argument('-j', help='Number of worker processes', type=int, default=os.cpu_count())
+    arg_parser.add_argument('-s', help='Maximum number of states the solver visits per candidate', type=int, default=20000)
+    arg_parser.add_argument('-t', help='Time limit per candidate in seconds', type=float, default=5)
+    arg_parser.add_argument('--width', help='Level width', type=int, default=DEFAULT_WIDTH)
+    arg_parser.add_argument('--height', help='Level height', type=int, default=DEFAULT_HEIGHT)
+    arg_parser.add_argument('--seed', help='Seed of the first candidate, candidates are numbered from here', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    start_time = time.monotonic()
+    levels = {} # level string -> (solution length, seed)
+    candidates = 0
+    next_seed = args.seed
+    with multiprocessing.Pool(args.j) as pool:
+        # Candidates go to the pool a batch at a time, Pool reads everything it's given up front.
+        while len(levels) < args.n:
+            jobs = [(seed, args.width, args.height, args.l, args.s, args.t) for seed in range(next_seed, next_seed + args.j * BATCH_SIZE)]
+            next_seed += len(jobs)
+            for seed, level, solution_length in pool.imap_unordered(generate, jobs, chunksize=4):
+                candidates += 1
+                if level is not None and level not in levels:
+                    levels[level] = (solution_length, seed)
+                    print('{}/{}: seed {}, {} moves ({} candidates, {:.0f} per minute)'.format(len(levels), args.n, seed, solution_length, candidates, candidates / (time.monotonic() - start_time) * 60))
+                    sys.stdout.flush()
+                    if len(levels) >= args.n:
+                        break
+
+    ordered = sorted(levels.items(), key=lambda item: item[1])
+    write_levels(args.o, [(level, 'Generated {} ({} moves)'.format(seed, solution_length)) for level, (solution_length, seed) in ordered])
+    print('Wrote {} levels to {}'.format(len(ordered), args.o))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,14 +2,22 @@ import pygame
 import argparse
 import easygui
 import configparser
+import os
+import queue
+import threading
+import time
 
 from Utils import *
 from GameState import GameState, LevelLoader
 from LevelDisplay import *
+from TextCache import TextCache
+from BackgroundSolver import BackgroundSolver
 
 TOOLBAR_THICKNESS = 0.1
 TILEBAR_THICKNESS = 0.2
 BUTTON_BORDER_THICKNESS = 0.1
+CHECK_DELAY = 0.3 # Seconds after the last edit before the level is checked
+CHECK_TIME_LIMIT = 10 # Seconds the solver gets to decide whether a level can be solved
 
 # Windows bug https://github.com/Microsoft/vscode/issues/39149#issuecomment-347260954
 import win_unicode_console
@@ -17,6 +25,7 @@ win_unicode_console.enable()
 
 arg_parser = argparse.ArgumentParser(description='Level editor for tape-escape.')
 arg_parser.add_argument('-w', help='Screen width in pixels', default=600)
+arg_parser.add_argument('--autosave', help='Save every this many seconds while there are unsaved changes (off by default)', type=float, default=None)
 args = arg_parser.parse_args()
 
 screen_width = int(args.w)
@@ -26,6 +35,8 @@ screen_size = (screen_width, screen_height)
 pygame.init()
 pygame.font.init()
 font = pygame.font.SysFont('Arial',30)
+status_font = pygame.font.SysFont('Arial',16)
+text_cache = TextCache()
 
 current_level = 0
 states = [GameState()]
@@ -141,43 +152,102 @@ class ToggleButtonGroup:
 action_buttons = list()
 level_names = dict()
 
+# Levels keep the string they were last serialized to, only levels edited since (see mark_dirty) are serialized again.
+level_strings = dict() # level index -> level string
+dirty_levels = set() # Indexes of levels changed since the last save
+last_save_time = time.monotonic()
+
+def mark_dirty(i):
+    dirty_levels.add(i)
+    level_strings.pop(i, None)
+
+def level_string(i):
+    if i not in level_strings:
+        # Levels that were never opened are written back as they were loaded.
+        level_strings[i] = states[i].serialize() if states[i] is not None else levelloader.level_string(i+1)
+    return level_strings[i]
+
 # Save button
 def save():
-    global states
-    config = configparser.ConfigParser()
-    config.add_section('Levels')
-    config.add_section('LevelNames')
-    for i, state in enumerate(states):
-        config.set('Levels', str(i+1), state.serialize())
+    global last_save_time
+    last_save_time = time.monotonic()
+    levels = []
+    for i in range(len(states)):
         if i not in level_names:
             level_names[i] = 'Level name '+str(i+1)
-        config.set('LevelNames', str(i+1), level_names[i])
+        levels.append((level_string(i), level_names[i]))
 
     # filename = easygui.filesavebox(default='levels.ini', filetypes=['*.ini'])
     filename = 'levels.ini'
-    try:
-        with open(filename, 'w') as file:
-            config.write(file)
-            file.close()
-    except (IOError, TypeError) as err:
-        print("File write failed: "+str(err))
-    
-    
+    # The file is written on the save thread, so the editor doesn't stop while it's written.
+    save_requests.put((filename, levels, set(dirty_levels)))
+    dirty_levels.clear()
+
+def write_levels_file(filename, levels):
+    # levels is a list of (level string, name).
+    config = configparser.ConfigParser()
+    config.add_section('Levels')
+    config.add_section('LevelNames')
+    for i, (level, name) in enumerate(levels):
+        config.set('Levels', str(i+1), level)
+        config.set('LevelNames', str(i+1), name)
+    # Write to a temporary file and rename it over the old one, so a crash part way leaves the old file intact.
+    temp_file = filename + '.tmp'
+    with open(temp_file, 'w') as file:
+        config.write(file)
+    os.replace(temp_file, filename)
+
+def run_saves():
+    # Save thread, writes the files save asks for in order until it gets None.
+    # The levels of a save that failed are handed back on save_failures, the main loop marks them dirty again.
+    while True:
+        request = save_requests.get()
+        if request is None:
+            break
+        filename, levels, saved_levels = request
+        try:
+            write_levels_file(filename, levels)
+        except Exception as err:
+            print("File write failed: "+str(err))
+            save_failures.put(saved_levels)
+        finally:
+            save_requests.task_done()
+
+save_requests = queue.Queue()
+save_failures = queue.Queue()
+save_thread = threading.Thread(target=run_saves, daemon=True)
+save_thread.start()
+
 action_buttons.append(Button(ButtonType.SAVE, screen, 0, 0, int(screen_width / 10), display.y_outer_offset, "images/save_icon.png", save))
 
 def load():
-    global states
+    global states, levelloader
+    # Let any save in progress finish first, so what's loaded is what was saved.
+    save_requests.join()
     states = []
+    level_strings.clear()
+    dirty_levels.clear()
+    # Failed saves were of the levels being replaced, there's nothing left to retry.
+    while not save_failures.empty():
+        save_failures.get()
     # filename = easygui.fileopenbox()
     filename = 'levels.ini'
     try:
-        levelloader = LevelLoader(filename)
+        # Saving rewrites the file anyway, so there's no point compiling the level cache here.
+        levelloader = LevelLoader(filename, use_cache=False)
     except (IOError, TypeError) as err:
         print("File load failed: "+str(err))
-    for i in range(len(levelloader.config['Levels'])):
-        states.append(levelloader.load_new_level_state(i+1))
-    for i in range(len(levelloader.config['LevelNames'])):
-        level_names[i] = levelloader.config['LevelNames'][str(i+1)]
+    # Levels are only parsed when they're first shown, see get_state.
+    for i in range(levelloader.level_count()):
+        states.append(None)
+        # Levels without a name keep the default save gives them.
+        if levelloader.level_name(i+1) != '':
+            level_names[i] = levelloader.level_name(i+1)
+
+def get_state(i):
+    if states[i] is None:
+        states[i] = levelloader.load_new_level_state(i+1)
+    return states[i]
 
 load()
 action_buttons.append(Button(ButtonType.LOAD, screen, int(screen_width / 10), 0, int(screen_width / 10), display.y_outer_offset, "images/load_icon.png", load))
@@ -200,9 +270,30 @@ def add_level():
     global states, current_level
     states.append(GameState())
     current_level = len(states)-1
+    mark_dirty(current_level)
 
 action_buttons.append(Button(ButtonType.ADD_LEVEL, screen, int(screen_width / 10)*2, screen_height - display.y_outer_offset, int(screen_width / 10), display.y_outer_offset, "images/plus_icon.png", add_level))
 
+# The level being shown is checked in the background while it's edited, see BackgroundSolver.check.
+level_checker = BackgroundSolver('levels.ini', time_limit=CHECK_TIME_LIMIT)
+check_due_time = 0 # When to check the level next, put back on every edit so checks wait for a pause
+checked_key = None # Which level, in which version, was checked last (see the main loop)
+checked_level = None # Level string of the last check asked for
+level_check = None # LevelCheck for checked_level, None until it comes back
+
+def check_status():
+    if level_checker.failed:
+        return "Level checks not available"
+    if level_check is None or time.monotonic() < check_due_time:
+        return "Checking..."
+    if level_check.problems:
+        return "; ".join(level_check.problems).capitalize()
+    if level_check.status == 'solved':
+        return "Solvable in {} moves".format(level_check.solution_length)
+    if level_check.status == 'unsolvable':
+        return "Unsolvable"
+    return "Unknown, solver gave up ({})".format(level_check.status)
+
 # Buttons for painting tiles
 tile_buttons = list()
 tile_button_defs = [
@@ -221,6 +312,7 @@ for x in range(len(tile_button_defs[0])):
 tile_button_group = ToggleButtonGroup(tile_buttons)
 
 # Main game loop
+drawn_panel_key = None
 finished = False
 while not finished:
 
@@ -233,9 +325,11 @@ while not finished:
                 if button.position_inside_button(mouse_position[0], mouse_position[1]):
                     button.action_func()
             tile_button_group.check_for_new_active(mouse_position)
-        grid_square = display.screen_position_to_grid_square(states[current_level], mouse_position)
+        grid_square = display.screen_position_to_grid_square(get_state(current_level), mouse_position)
         if grid_square != None and pygame.mouse.get_pressed()[0]:
-            states[current_level].update_grid_square(grid_square[0], grid_square[1], button_type_to_tile_type_map[tile_button_group.get_active_button().button_type])
+            get_state(current_level).update_grid_square(grid_square[0], grid_square[1], button_type_to_tile_type_map[tile_button_group.get_active_button().button_type])
+            mark_dirty(current_level)
+            check_due_time = time.monotonic() + CHECK_DELAY
         # Keyboard commands
         elif event.type == pygame.KEYDOWN:
             pass
@@ -243,11 +337,46 @@ while not finished:
         elif event.type == pygame.QUIT:
             finished = True
 
-    display.render_state(states[current_level])
-    for button in action_buttons + tile_buttons:
-        button.draw()
-    level_number_display = font.render(str(current_level+1), False, RED)
-    screen.blit(level_number_display, (int(screen_width / 10)*5, screen_height - display.y_outer_offset))
-    pygame.display.flip()
-
+    # Check the level once editing pauses. Asking about a new level string cancels the check in progress.
+    # Every edit changes the terrain version or the hash, so the level is only serialized when one of those moves.
+    state = get_state(current_level)
+    check_key = (id(state), state.terrain_version, state.zobrist_hash)
+    if check_key != checked_key and time.monotonic() >= check_due_time:
+        checked_key = check_key
+        level = level_string(current_level)
+        if level != checked_level:
+            checked_level = level
+            level_check = level_checker.check(level)
+    elif level_check is None:
+        level_check = level_checker.poll()
+
+    # Levels from failed saves are still unsaved, so the next save tries them again.
+    while not save_failures.empty():
+        dirty_levels.update(save_failures.get())
+    if args.autosave is not None and dirty_levels and time.monotonic() - last_save_time >= args.autosave:
+        save()
+
+    # Only the parts of the level that changed are redrawn (see LevelDisplay.render_state). A new level or an
+    # edit to the terrain redraws the whole screen, which paints over the buttons and text, so they're drawn
+    # again then, or when they change.
+    changed_rects = display.render_state(state)
+    status = check_status() if checked_level is not None else ""
+    panel_key = (current_level, status, tile_button_group.active)
+    if screen.get_rect() in changed_rects or panel_key != drawn_panel_key:
+        for button in action_buttons + tile_buttons:
+            button.draw()
+        text_rect = [int(screen_width / 10)*5, screen_height - display.y_outer_offset, screen_width - int(screen_width / 10)*5, display.y_outer_offset]
+        screen.fill(BLACK, text_rect)
+        level_number_display = text_cache.render(font, str(current_level+1), RED, False)
+        screen.blit(level_number_display, (int(screen_width / 10)*5, screen_height - display.y_outer_offset))
+        status_display = text_cache.render(status_font, status, RED, False)
+        screen.blit(status_display, (int(screen_width / 10)*6, screen_height - display.y_outer_offset))
+        drawn_panel_key = panel_key
+        changed_rects = [screen.get_rect()]
+    if changed_rects:
+        pygame.display.update(changed_rects)
+
+level_checker.close()
+save_requests.put(None)
+save_thread.join()
 pygame.quit()
\ No newline at end of file
@@ -0,0 +1,41 @@
+import argparse
+import sys
+import time
+
+from Replay import read_replay, ReplayPlayer, op_names
+
+# Re-simulates a replay recorded with tape-escape.py --record, without a screen,
+# and reports where the session ended up.
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Play back a tape-escape replay file without a screen.')
+    arg_parser.add_argument('replay', help='Replay file to play')
+    arg_parser.add_argument('-f', help='ini file containing levels', default='levels.ini')
+    arg_parser.add_argument('-i', help='Stop after this many operations (default all)', type=int, default=None)
+    arg_parser.add_argument('--ignore-fingerprint', help='Play even if the levels file differs from the recording', action='store_true')
+    arg_parser.add_argument('--list', help='Print the operations in the replay', action='store_true')
+    args = arg_parser.parse_args()
+
+    try:
+        replay = read_replay(args.replay)
+        player = ReplayPlayer(replay, args.f, check_fingerprint=not args.ignore_fingerprint)
+    except (IOError, ValueError) as err:
+        print('Replay load failed: '+str(err))
+        return 1
+
+    if args.list:
+        for i, (op, level_no) in enumerate(replay.ops):
+            print('{:6d} {}'.format(i, op_names[op]) + (' '+str(level_no) if level_no is not None else ''))
+
+    start_time = time.perf_counter()
+    player.seek(len(replay.ops) if args.i is None else args.i)
+    elapsed = time.perf_counter() - start_time
+
+    print('Operations: {} of {} ({:.0f} per second)'.format(player.index, len(replay.ops), player.index / elapsed if elapsed > 0 else 0))
+    print('Level: {}'.format(player.level_no))
+    print('Game complete: {}'.format('yes' if player.game_complete else 'no'))
+    print('State hash: {:016x}'.format(player.state.zobrist_hash))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
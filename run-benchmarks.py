@@ -0,0 +1,276 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from Utils import *
+from GameState import LevelLoader, GameState
+from StateHistory import StateHistory
+from Simulation import Action, Event, step, reset_level
+
+# Microbenchmarks for the GameState hot paths.
+# Every benchmark runs on each level in the levels file and on synthetic block-dense grids.
+# Results are written as JSON and compared against a stored baseline, a benchmark that got
+# slower (or allocates more) than the thresholds allow counts as a regression.
+
+DIRECTIONS = [(0,-1), (1,0), (0,1), (-1,0)]
+SYNTHETIC_SIZES = [(30, 20), (120, 80)] # The editor canvas, and a much bigger grid
+BLOCK_LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+def synthetic_level(width, height, seed):
+    # A level packed with as many blocks as there are letters, on floor with a few pits, surrounded by wall.
+    rng = random.Random(seed)
+    rows = [['*' if rng.random() > 0.1 else '.' for x in range(width)] for y in range(height)]
+    for x in range(width):
+        rows[0][x] = rows[height-1][x] = '0'
+    for y in range(height):
+        rows[y][0] = rows[y][width-1] = '0'
+    rows[height//2][width//2] = '@'
+    rows[1][1] = '+'
+    # Blocks are rectangles up to a third of the grid in size, so most of them end up touching others
+    # and pushes have long chains to resolve.
+    for letter in BLOCK_LETTERS:
+        block_width = rng.randint(1, max(1, width//6))
+        block_height = rng.randint(1, max(1, height//6))
+        for attempt in range(100):
+            left = rng.randint(1, width - block_width - 1)
+            top = rng.randint(1, height - block_height - 1)
+            squares = [(x, y) for x in range(left, left + block_width) for y in range(top, top + block_height)]
+            if all(rows[y][x] in '*.' for x, y in squares):
+                for x, y in squares:
+                    rows[y][x] = letter.upper() if rows[y][x] == '*' else letter
+                break
+    return '\n'.join(''.join(row) for row in rows)
+
+class Workload:
+    # A level to run the benchmarks on. load makes a new starting state for it.
+
+    def __init__(self, name, load):
+        self.name = name
+        self.load = load
+        self.starting_state = load()
+
+def get_workloads(levels_file):
+    level_loader = LevelLoader(levels_file)
+    workloads = []
+    for level_no in range(1, level_loader.level_count() + 1):
+        load = lambda level_no=level_no: level_loader.load_new_level_state(level_no)
+        workloads.append(Workload('level{:02d}'.format(level_no), load))
+    for width, height in SYNTHETIC_SIZES:
+        load = lambda level=synthetic_level(width, height, width * height): GameState(level=level)
+        workloads.append(Workload('synthetic{}x{}'.format(width, height), load))
+    return workloads
+
+def sample_states(starting_state, count, rng):
+    # States reached by playing randomly from the start, restarting whenever the player falls off or wins.
+    # These are the kind of states the hot paths see during play.
+    states = []
+    state = reset_level(starting_state)
+    actions = list(Action)
+    while len(states) < count:
+        state, events = step(state, rng.choice(actions))
+        if Event.GOAL_REACHED in events or Event.FELL_OFF in events:
+            state = reset_level(starting_state)
+        elif Event.NO_EFFECT not in events:
+            states.append(state.clone())
+    return states
+
+def fresh_copies(states):
+    # Clones with their own block lookup table, so that the copy-on-write copy isn't counted as part of an operation.
+    copies = []
+    for state in states:
+        state = state.clone()
+        state.own_block_grid()
+        copies.append(state)
+    return copies
+
+def time_calls(function, args_list):
+    # Returns a function that makes the calls and returns the number of calls and the time they took.
+    def run():
+        start_time = time.perf_counter()
+        for args in args_list:
+            function(*args)
+        return len(args_list), time.perf_counter() - start_time
+    return run
+
+# Each benchmark takes the workload, the states sampled from it and a random generator, does any setup
+# and returns a function that runs the benchmark and returns the number of operations and the time they took.
+
+def bench_extend_tape(workload, states, rng):
+    return time_calls(GameState.extend_tape, [(state,) for state in fresh_copies(states)])
+
+def bench_retract_tape(workload, states, rng):
+    return time_calls(GameState.retract_tape, [(state,) for state in fresh_copies(states)])
+
+def bench_change_direction(workload, states, rng):
+    # Turns to either side, collecting all obstructions as the game does every frame.
+    return time_calls(GameState.change_direction, [(state, rotate_right(state.player_direction) if rng.random() < 0.5 else vector_scalar_multiply(rotate_right(state.player_direction), -1)) for state in fresh_copies(states)])
+
+def get_block_pushes(states, rng, movable_only):
+    # A (state, block, direction) for each sampled state that has blocks.
+    pushes = []
+    for state in fresh_copies(states):
+        candidates = [(block_key, direction) for block_key in state.blocks for direction in DIRECTIONS]
+        if movable_only:
+            candidates = [(block_key, direction) for block_key, direction in candidates if state.block_can_move_one(block_key, direction)]
+            state.push_cache.clear()
+        if candidates:
+            pushes.append((state,) + rng.choice(candidates))
+    return pushes
+
+def bench_block_can_move_one(workload, states, rng):
+    return time_calls(GameState.block_can_move_one, get_block_pushes(states, rng, False))
+
+def bench_move_block_one(workload, states, rng):
+    return time_calls(GameState.move_block_one, get_block_pushes(states, rng, True))
+
+def bench_update_block_grid(workload, states, rng):
+    return time_calls(GameState.update_block_grid, [(state,) for state in fresh_copies(states)])
+
+def bench_player_fallen_off(workload, states, rng):
+    return time_calls(GameState.player_fallen_off, [(state,) for state in fresh_copies(states)])
+
+def play_with_history(starting_state, count, rng):
+    # Plays randomly the way the game does, adding to the history after each tape move.
+    # Returns the history and the time spent in StateHistory.add.
+    # Playing is part of the benchmark here, so the allocations include those made by the moves.
+    history = StateHistory(count + 1)
+    state = reset_level(starting_state)
+    history.add((state, 1))
+    actions = list(Action)
+    adds = 0
+    add_time = 0
+    while adds < count:
+        action = rng.choice(actions)
+        state, events = step(state, action)
+        if Event.GOAL_REACHED in events or Event.FELL_OFF in events:
+            state = reset_level(starting_state)
+        if action in (Action.EXTEND, Action.RETRACT, Action.FLIP):
+            start_time = time.perf_counter()
+            history.add((state, 1))
+            add_time += time.perf_counter() - start_time
+            adds += 1
+    return history, add_time
+
+def bench_history_add(workload, states, rng):
+    def run():
+        history, add_time = play_with_history(workload.starting_state, len(states), rng)
+        return len(states), add_time
+    return run
+
+def bench_history_back(workload, states, rng):
+    history, add_time = play_with_history(workload.starting_state, len(states), rng)
+    return time_calls(history.back, [()] * len(states))
+
+def bench_load_level(workload, states, rng):
+    # LevelLoader.load_new_level_state for the real levels, parsing the level string for the synthetic ones.
+    return time_calls(workload.load, [()] * max(1, len(states) // 20))
+
+BENCHMARKS = [
+    ('extend_tape', bench_extend_tape),
+    ('retract_tape', bench_retract_tape),
+    ('change_direction', bench_change_direction),
+    ('block_can_move_one', bench_block_can_move_one),
+    ('move_block_one', bench_move_block_one),
+    ('update_block_grid', bench_update_block_grid),
+    ('player_fallen_off', bench_player_fallen_off),
+    ('history_add', bench_history_add),
+    ('history_back', bench_history_back),
+    ('load_level', bench_load_level),
+]
+
+def run_benchmark(benchmark, workload, states, seed, repeat):
+    # Best of repeat timed runs, then one more run under tracemalloc for the allocations.
+    best_rate = 0
+    ops = 0
+    for i in range(repeat):
+        ops, seconds = benchmark(workload, states, random.Random(seed))()
+        if ops and seconds > 0:
+            best_rate = max(best_rate, ops / seconds)
+    if ops == 0:
+        return None
+    run = benchmark(workload, states, random.Random(seed))
+    tracemalloc.start()
+    run()
+    current_memory, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'ops': ops,
+        'ops_per_sec': round(best_rate, 1),
+        'peak_kb': round(peak_memory / 1024, 1), # Most memory in use at once during the run
+        'retained_kb': round(current_memory / 1024, 1), # Memory still held at the end (e.g. by the history)
+    }
+
+def run_benchmarks(levels_file, sample_count, repeat, name_filter):
+    results = {}
+    for workload in get_workloads(levels_file):
+        states = sample_states(workload.starting_state, sample_count, random.Random(workload.name))
+        for benchmark_name, benchmark in BENCHMARKS:
+            name = benchmark_name + '/' + workload.name
+            if name_filter and name_filter not in name:
+                continue
+            result = run_benchmark(benchmark, workload, states, name, repeat)
+            if result is not None:
+                results[name] = result
+                print('{:45s} {:>12.0f} ops/s {:>10.1f} KB peak'.format(name, result['ops_per_sec'], result['peak_kb']))
+                sys.stdout.flush()
+    return results
+
+def compare(results, baseline, threshold, alloc_threshold):
+    # Returns the list of benchmarks that regressed against the baseline.
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        new = results[name]
+        speed_change = new['ops_per_sec'] / old['ops_per_sec'] - 1 if old['ops_per_sec'] else 0
+        # Small absolute changes in memory are noise.
+        memory_regressed = new['peak_kb'] > old['peak_kb'] * (1 + alloc_threshold) + 16
+        if speed_change < -threshold or memory_regressed:
+            regressions.append(name)
+            print('REGRESSION {:45s} {:+.0%} speed, {:.1f} -> {:.1f} KB peak'.format(name, speed_change, old['peak_kb'], new['peak_kb']))
+    return regressions
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Benchmark the game engine hot paths.')
+    arg_parser.add_argument('-f', help='ini file containing levels', default='levels.ini')
+    arg_parser.add_argument('-o', help='File to write the results to', default='benchmark-results.json')
+    arg_parser.add_argument('-b', help='Baseline results to compare against', default='benchmark-baseline.json')
+    arg_parser.add_argument('-n', help='Number of states to sample per level', type=int, default=500)
+    arg_parser.add_argument('-r', help='Number of timed runs per benchmark (the best is kept)', type=int, default=3)
+    arg_parser.add_argument('-k', help='Only run benchmarks whose name contains this', default=None)
+    arg_parser.add_argument('--threshold', help='Slowdown that counts as a regression (0.2 = 20%%)', type=float, default=0.2)
+    arg_parser.add_argument('--alloc-threshold', help='Increase in peak memory that counts as a regression', type=float, default=0.2)
+    arg_parser.add_argument('--save-baseline', help='Save the results as the new baseline', action='store_true')
+    args = arg_parser.parse_args()
+
+    results = run_benchmarks(args.f, args.n, args.r, args.k)
+    output = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    with open(args.o, 'w') as file:
+        json.dump(output, file, indent=1, sort_keys=True)
+    if args.save_baseline:
+        with open(args.b, 'w') as file:
+            json.dump(output, file, indent=1, sort_keys=True)
+        print('Saved baseline to '+args.b)
+        return 0
+    if not os.path.exists(args.b):
+        print('No baseline at {}, run with --save-baseline to make one.'.format(args.b))
+        return 0
+    with open(args.b) as file:
+        baseline = json.load(file)['results']
+    regressions = compare(results, baseline, args.threshold, args.alloc_threshold)
+    print('{} regressions in {} benchmarks'.format(len(regressions), len(results)))
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
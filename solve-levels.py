@@ -0,0 +1,59 @@
+import argparse
+import multiprocessing
+import os
+import sys
+
+from GameState import LevelLoader, GameState
+from Solver import solve, SolverResult
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, memory limits are skipped there.
+    resource = None
+
+# Solves every level in a levels file in parallel and reports the shortest solution for each.
+
+def limit_memory(memory_limit_mb):
+    # Run in each worker process. Caps the address space so a runaway search raises MemoryError
+    # instead of taking the whole machine down.
+    if resource is not None and memory_limit_mb:
+        limit = memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def solve_level(job):
+    levels_file, level_no, time_limit, max_states = job
+    try:
+        result = solve(LevelLoader(levels_file).load_new_level_state(level_no), time_limit=time_limit, max_states=max_states)
+    except MemoryError:
+        result = SolverResult('out of memory', None, 0)
+    return level_no, result
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Find the shortest solution to every level in a levels file.')
+    arg_parser.add_argument('-f', help='ini file containing levels', default='levels.ini')
+    arg_parser.add_argument('-j', help='Number of worker processes', type=int, default=os.cpu_count())
+    arg_parser.add_argument('-t', help='Time limit per level in seconds', type=float, default=60)
+    arg_parser.add_argument('-m', help='Memory limit per worker in megabytes', type=int, default=2048)
+    arg_parser.add_argument('-s', help='Maximum number of states to visit per level', type=int, default=None)
+    arg_parser.add_argument('levels', help='Level numbers to solve (default all)', type=int, nargs='*')
+    args = arg_parser.parse_args()
+
+    # Loading the levels here also makes sure the compiled level cache is up to date before the workers read it.
+    level_loader = LevelLoader(args.f)
+    level_nos = args.levels or list(range(1, level_loader.level_count() + 1))
+    jobs = [(args.f, level_no, args.t, args.s) for level_no in level_nos]
+
+    all_solved = True
+    with multiprocessing.Pool(args.j, initializer=limit_memory, initargs=(args.m,)) as pool:
+        for level_no, result in pool.imap(solve_level, jobs):
+            print('Level {} {}: {} ({} states explored)'.format(level_no, level_loader.level_name(level_no), result.status, result.explored))
+            if result.solution is not None:
+                print('    {} moves: {}'.format(len(result.solution), ' '.join(action.name.lower() for action in result.solution)))
+            else:
+                all_solved = False
+            sys.stdout.flush()
+    return 0 if all_solved else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
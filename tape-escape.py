@@ -1,12 +1,18 @@
 import pygame
-from copy import deepcopy
 import pdb
 import argparse
+import time
 
 from Utils import *
 from GameState import LevelLoader, GameState
 from StateHistory import StateHistory
 from LevelDisplay import *
+from TextCache import TextCache
+from Simulation import Action, Event, step, load_level, reset_level
+from Replay import ReplayRecorder, OP_RESTART, OP_UNDO, OP_REDO, OP_LEVEL
+from FrameScheduler import FrameScheduler, DEFAULT_FPS
+from PerfOverlay import PerfOverlay
+from BackgroundSolver import BackgroundSolver, DeadlockCheck
 
 # Windows bug https://github.com/Microsoft/vscode/issues/39149#issuecomment-347260954
 import os
@@ -17,6 +23,8 @@ if os.name == 'nt':
 arg_parser = argparse.ArgumentParser(description='A game where you play as a tape measure.')
 arg_parser.add_argument('-w', help='Screen width in pixels', default=600)
 arg_parser.add_argument('-f', help='ini file containing levels', default='levels.ini')
+arg_parser.add_argument('--record', help='Record the session to this replay file', default=None)
+arg_parser.add_argument('--fps', help='Maximum frames per second (0 for no limit)', type=int, default=DEFAULT_FPS)
 args = arg_parser.parse_args()
 
 levels_file = args.f
@@ -36,13 +44,17 @@ for i in range(pygame.joystick.get_count()):
     joysticks.append(joystick)
 
 level_loader = LevelLoader(levels_file)
+hint_solver = None # Started the first time hints are turned on
+# Deadlock checks have their own worker, so they don't cancel hint searches or wait behind them.
+deadlock_solver = None # Started the first time a position needs checking
 
 current_level = 1
-starting_state = level_loader.load_new_level_state(current_level)
-state = deepcopy(starting_state)
+starting_state = load_level(level_loader, current_level)
+state = reset_level(starting_state)
 
-MAX_HISTORY = 50
+MAX_HISTORY = 1000
 history = StateHistory(MAX_HISTORY)
+recorder = ReplayRecorder(args.record, levels_file, current_level, MAX_HISTORY) if args.record else None
 history.add((state, current_level))
 
 screen = pygame.display.set_mode(screen_size)
@@ -65,11 +77,15 @@ input_mode = InputMode.MOUSE_AND_KEYS
 h1_font = pygame.font.SysFont('monospace', 50, bold=True)
 h2_font = pygame.font.SysFont('monospace', 30, bold=True, italic=True)
 normal_font = pygame.font.SysFont('monospace', 20)
+text_cache = TextCache()
+scheduler = FrameScheduler(args.fps)
+perf_overlay = PerfOverlay(screen, pygame.font.SysFont('monospace', 12), 1000 / (args.fps or DEFAULT_FPS))
 
 # Main menu
 finished = False
+menu_drawn = False
 while not finished:
-    for event in pygame.event.get():
+    for event in scheduler.get_events():
         if event.type == pygame.QUIT:
             pygame.quit()
             quit()
@@ -79,24 +95,28 @@ while not finished:
         elif event.type == pygame.JOYBUTTONDOWN:
             input_mode = InputMode.GAMEPAD_AND_KEYS
             finished = True
+    # The menu never changes, so it only needs drawing again if the window was covered up.
+    if menu_drawn and not scheduler.exposed:
+        continue
+    menu_drawn = True
     # Draw the menu
     screen.fill(BLACK)
     # Draw the name of the game
-    game_name = h1_font.render('Tape Escape', 1, SILVER)
+    game_name = text_cache.render(h1_font, 'Tape Escape', SILVER)
     game_name_rect = game_name.get_rect()
     game_name_pos = (int(screen_width/2 - game_name_rect[2]/2), int(screen_height/2 - game_name_rect[3]*3))
     screen.blit(game_name, game_name_pos)
     # Draw the tagline
-    tagline = h2_font.render('Will you measure up?', 1, LIGHT_GREY)
+    tagline = text_cache.render(h2_font, 'Will you measure up?', LIGHT_GREY)
     tagline_rect = tagline.get_rect()
     tagline_pos = (int(screen_width/2 - tagline_rect[2]/2), int(screen_height/2 - game_name_rect[3]*2))
     screen.blit(tagline, tagline_pos)
     # Draw the instructions
-    instruction1 = normal_font.render('Mouse click -> Play with Mouse controls.', 1, BROWN)
+    instruction1 = text_cache.render(normal_font, 'Mouse click -> Play with Mouse controls.', BROWN)
     instruction1_rect = instruction1.get_rect()
     instruction1_pos = (int(screen_width/2 - instruction1_rect[2]/2), int(screen_height/2 - instruction1_rect[3]))
     screen.blit(instruction1, instruction1_pos)
-    instruction2 = normal_font.render('Gamepad button -> Play with Gamepad controls.', 1, BROWN)
+    instruction2 = text_cache.render(normal_font, 'Gamepad button -> Play with Gamepad controls.', BROWN)
     instruction2_rect = instruction2.get_rect()
     instruction2_pos = (int(screen_width/2 - instruction2_rect[2]/2), int(screen_height/2))
     screen.blit(instruction2, instruction2_pos)
@@ -104,17 +124,56 @@ while not finished:
     pygame.display.flip()
 
 # User input functions
+def add_to_history(entry):
+    # History updates are timed on their own for the performance overlay, wherever they happen.
+    start_time = time.perf_counter()
+    history.add(entry)
+    perf_overlay.add_time('history', time.perf_counter() - start_time)
+
+def history_back():
+    start_time = time.perf_counter()
+    entry = history.back()
+    perf_overlay.add_time('history', time.perf_counter() - start_time)
+    return entry
+
+def history_forward():
+    start_time = time.perf_counter()
+    entry = history.forward()
+    perf_overlay.add_time('history', time.perf_counter() - start_time)
+    return entry
+
+def forget_last_history_state():
+    start_time = time.perf_counter()
+    history.forget_last_state()
+    perf_overlay.add_time('history', time.perf_counter() - start_time)
+
+def play(action):
+    # All moves made by the player go through here or turn.
+    step(state, action)
+    if recorder is not None:
+        recorder.record_action(action)
+
+def turn(action, obstructions):
+    # Turning is tried every frame, only turns that changed something are worth recording.
+    _, events = step(state, action, obstructions)
+    if recorder is not None and Event.NO_EFFECT not in events:
+        recorder.record_action(action)
+
+def record(op, level_no=None):
+    if recorder is not None:
+        recorder.record(op, level_no)
+
 def extend_tape():
-    state.extend_tape()
-    history.add((state, current_level))
+    play(Action.EXTEND)
+    add_to_history((state, current_level))
 
 def retract_tape():
-    state.retract_tape()
-    history.add((state, current_level))
+    play(Action.RETRACT)
+    add_to_history((state, current_level))
 
 def change_orientation():
-    state.switch_orientation()
-    history.add((state, current_level))
+    play(Action.FLIP)
+    add_to_history((state, current_level))
 
 def toggle_input_mode():
     global input_mode
@@ -126,40 +185,67 @@ def toggle_input_mode():
 def skip_level():
     global current_level, starting_state, state
     current_level += 1
-    starting_state = level_loader.load_new_level_state(current_level)
-    state = deepcopy(starting_state)
-    history.add((state, current_level))
+    starting_state = load_level(level_loader, current_level)
+    state = reset_level(starting_state)
+    record(OP_LEVEL, current_level)
+    add_to_history((state, current_level))
 
 def previous_level():
     global current_level, starting_state, state
     current_level -= 1
-    starting_state = level_loader.load_new_level_state(current_level)
-    state = deepcopy(starting_state)
-    history.add((state, current_level))
+    starting_state = load_level(level_loader, current_level)
+    state = reset_level(starting_state)
+    record(OP_LEVEL, current_level)
+    add_to_history((state, current_level))
 
 def restart_level():
     global state
-    state = deepcopy(starting_state)
-    history.add((state, current_level))
+    state = reset_level(starting_state)
+    add_to_history((state, current_level))
+    record(OP_RESTART)
 
 def last_level():
     global current_level, starting_state, state
-    current_level = len(level_loader.config["Levels"])
-    starting_state = level_loader.load_new_level_state(current_level)
-    state = deepcopy(starting_state)
-    history.add((state, current_level))
+    current_level = level_loader.level_count()
+    starting_state = load_level(level_loader, current_level)
+    state = reset_level(starting_state)
+    record(OP_LEVEL, current_level)
+    add_to_history((state, current_level))
 
 def undo():
     global state, current_level
-    state, current_level = history.back()
+    state, current_level = history_back()
+    record(OP_UNDO)
 
 def redo():
     global state, current_level
-    state, current_level = history.forward()
+    state, current_level = history_forward()
+    record(OP_REDO)
 
 def pause_game():
     pass
 
+def toggle_hints():
+    # While hints are on, the next move from whatever state the player is in is worked out in the background.
+    global hints_on, hint, hint_checked_key, hint_solver
+    hints_on = not hints_on
+    if hints_on and hint_solver is None:
+        hint_solver = BackgroundSolver(levels_file)
+    hint = None
+    hint_checked_key = None
+    if not hints_on:
+        hint_solver.cancel()
+
+def toggle_perf_overlay():
+    perf_overlay.toggle()
+    display.invalidate()
+
+def handle_input(input_function):
+    # Run the function mapped to a button, timing it for the performance overlay.
+    start_time = time.perf_counter()
+    input_function()
+    perf_overlay.record_action(input_function.__name__, time.perf_counter() - start_time)
+
 def quit_game():
     global finished
     finished = True
@@ -177,6 +263,8 @@ button_mapping = {
     (pygame.KEYDOWN, pygame.K_q): quit_game,
     (pygame.KEYDOWN, pygame.K_ESCAPE): pause_game,
     (pygame.KEYDOWN, pygame.K_9): last_level,
+    (pygame.KEYDOWN, pygame.K_h): toggle_hints,
+    (pygame.KEYDOWN, pygame.K_F3): toggle_perf_overlay,
     (pygame.JOYBUTTONDOWN, 5): extend_tape,
     (pygame.JOYBUTTONDOWN, 4): retract_tape,
     (pygame.JOYBUTTONDOWN, 3): restart_level,
@@ -187,32 +275,119 @@ button_mapping = {
     (pygame.JOYBUTTONDOWN, 0): change_orientation,
 }
 
+hint_action_names = {
+    Action.EXTEND: "Extend tape",
+    Action.RETRACT: "Retract tape",
+    Action.FLIP: "Flip tape",
+    Action.FACE_NORTH: "Face up",
+    Action.FACE_EAST: "Face right",
+    Action.FACE_SOUTH: "Face down",
+    Action.FACE_WEST: "Face left",
+}
+
+def hint_text():
+    if hint_solver.failed:
+        return "Hint: not available"
+    if hint is None:
+        return "Hint: thinking..."
+    if hint.action is None:
+        return "Hint: no solution found" if hint.status != 'solved' else "Hint: you're there!"
+    return "Hint: " + hint_action_names[hint.action]
+
+def render_hud():
+    # Compose the control help and level name onto a transparent surface the size of the screen.
+    hud = pygame.Surface(screen_size, pygame.SRCALPHA)
+    # Button config
+    button_config_lines = ["Controls:",
+                         "Move mouse - change direction",
+                         "Left click - Extend tape",
+                         "Right click - Retract tape",
+                         "Middle click - Flip tape",
+                         "R Key - Restart level",
+                         "Z Key - Undo move",
+                         "Y Key - Redo move",
+                         "H Key - Hints",
+                         "Q Key - Quit"]
+    if input_mode == InputMode.GAMEPAD_AND_KEYS:
+        button_config_lines = ["Controls:",
+                             "Left stick - change direction",
+                             "RB - Extend tape",
+                             "LB - Retract tape",
+                             "A - Flip tape",
+                             "Y - Restart level",
+                             "X - Undo move",
+                             "B - Redo move",
+                             "H Key - Hints",
+                             "Select - Quit"]
+    for i, line in enumerate(button_config_lines):
+        instruction = text_cache.render(normal_font, line, BROWN)
+        instruction_rect = instruction.get_rect()
+        instruction_rect.right = screen_width - 5
+        instruction_rect.top += instruction_rect.height * i
+        hud.blit(instruction, instruction_rect)
+
+    # Restart prompt when there's no way left to reach the goal
+    if stuck:
+        restart_button = "Y" if input_mode == InputMode.GAMEPAD_AND_KEYS else "R"
+        stuck_message = text_cache.render(normal_font, "No way out! Press {} to restart".format(restart_button), RED)
+        stuck_message_rect = stuck_message.get_rect()
+        stuck_message_rect.left = 0 + 5
+        stuck_message_rect.top = 0 + 5
+        hud.blit(stuck_message, stuck_message_rect)
+
+    # Hint for the next move
+    if hints_on:
+        hint_message = text_cache.render(normal_font, hint_text(), LIGHT_GREEN)
+        hint_message_rect = hint_message.get_rect()
+        hint_message_rect.left = 0 + 5
+        hint_message_rect.top = 0 + 5 + hint_message_rect.height
+        hud.blit(hint_message, hint_message_rect)
+
+    # Level name
+    level_name = text_cache.render(normal_font, level_loader.level_name(current_level), LIGHT_GREEN)
+    level_name_rect = level_name.get_rect()
+    level_name_rect.left = 0 + 5
+    level_name_rect.bottom = screen_height - 5
+    hud.blit(level_name, level_name_rect)
+    return hud
+
 # Main game loop
 axis_values = [0,0,0,0,0]
+drawn_hud_key = None
+hud_panel = None
+stuck = False
+stuck_check = None
+stuck_checked_key = None
+hints_on = False
+hint = None
+hint_checked_key = None
 finished = False
 game_complete = False
+scheduler.request_frame()
 while not finished:
     # Capture input and update game state
     obstruction_coords = None
-    for event in pygame.event.get():
+    events = scheduler.get_events()
+    perf_overlay.begin_frame()
+    for event in events:
         # Capture button input from mouse or joystick
         if (
             ( input_mode == InputMode.MOUSE_AND_KEYS and event.type == pygame.MOUSEBUTTONDOWN ) or
             ( input_mode == InputMode.GAMEPAD_AND_KEYS and event.type == pygame.JOYBUTTONDOWN )
         ):
             if (event.type, event.button) in button_mapping:
-                button_mapping[(event.type, event.button)]()
+                handle_input(button_mapping[(event.type, event.button)])
         # Capture any joypad analog stick input
         elif event.type == pygame.JOYAXISMOTION:
             axis_values[event.axis] = event.value
         # Keyboard input
         elif event.type == pygame.KEYDOWN:
             if (event.type, event.key) in button_mapping:
-                button_mapping[(event.type, event.key)]()
+                handle_input(button_mapping[(event.type, event.key)])
         # Quit game if QUIT signal is detected
         elif event.type == pygame.QUIT:
             finished = True
-    
+    perf_overlay.lap('events')
 
     if input_mode == InputMode.MOUSE_AND_KEYS:
         # Capture mouse hover position to determine which way to face
@@ -234,85 +409,128 @@ while not finished:
         # w X e
         #  / \
         # / s \
+        obstruction_coords = set()
         if abs(axis_values[0]) < axis_values[1]:
-            obstruction_coords = state.change_direction((0, 1))
+            turn(Action.FACE_SOUTH, obstruction_coords)
         elif abs(axis_values[0]) < -axis_values[1]:
-            obstruction_coords = state.change_direction((0, -1))
+            turn(Action.FACE_NORTH, obstruction_coords)
         elif axis_values[0] > abs(axis_values[1]):
-            obstruction_coords = state.change_direction((1, 0))
+            turn(Action.FACE_EAST, obstruction_coords)
         elif -axis_values[0] > abs(axis_values[1]):
-            obstruction_coords = state.change_direction((-1, 0))
+            turn(Action.FACE_WEST, obstruction_coords)
+    perf_overlay.lap('turn')
 
     display.obstruction_coords = obstruction_coords
-    display.render_state(state)
-
-    # Draw button config
-    button_config_lines = ["Controls:",
-                         "Move mouse - change direction",
-                         "Left click - Extend tape",
-                         "Right click - Retract tape",
-                         "Middle click - Flip tape",
-                         "R Key - Restart level",
-                         "Z Key - Undo move",
-                         "Y Key - Redo move",
-                         "Q Key - Quit"]
-    if input_mode == InputMode.GAMEPAD_AND_KEYS:
-        button_config_lines = ["Controls:",
-                             "Left stick - change direction",
-                             "RB - Extend tape",
-                             "LB - Retract tape",
-                             "A - Flip tape",
-                             "Y - Restart level",
-                             "X - Undo move",
-                             "B - Redo move",
-                             "Select - Quit"]
-    for i, line in enumerate(button_config_lines):
-        instruction = normal_font.render(line, 1, BROWN)
-        instruction_rect = instruction.get_rect()
-        instruction_rect.right = screen_width - 5
-        instruction_rect.top += instruction_rect.height * i
-        screen.blit(instruction, instruction_rect)
-
-    # Draw level name
-    level_name = normal_font.render(level_loader.config['LevelNames'][str(current_level)], 1, LIGHT_GREEN)
-    level_name_rect = level_name.get_rect()
-    level_name_rect.left = 0 + 5
-    level_name_rect.bottom = screen_height - 5
-    screen.blit(level_name, level_name_rect)
+    # Only check for deadlock when the state has changed. The check runs in the background, as the first
+    # one on a level searches every position it can reach without blocks (see GameState.is_deadlocked_without_blocks).
+    # Only positions with no blocks left are decided, and restarting from the start of a level wouldn't help,
+    # so the worker isn't asked (or started) for anything else. Nothing is shown until the answer is in.
+    stuck_key = (current_level, state.zobrist_hash)
+    if stuck_key != stuck_checked_key:
+        if any(state.blocks.values()) or state == starting_state:
+            stuck_check = DeadlockCheck(False)
+        else:
+            if deadlock_solver is None:
+                deadlock_solver = BackgroundSolver(levels_file)
+            stuck_check = deadlock_solver.deadlock(current_level, state)
+        stuck_checked_key = stuck_key
+    elif stuck_check is None:
+        stuck_check = deadlock_solver.poll()
+    if stuck_check is None and not deadlock_solver.failed:
+        scheduler.request_frame()
+    stuck = stuck_check is not None and stuck_check.deadlocked
+    perf_overlay.lap('deadlock')
+    # Ask for a hint whenever the state changes, which cancels the search for the last one.
+    # Keep the frames coming until the answer is in.
+    if hints_on:
+        hint_key = (current_level, state.zobrist_hash)
+        if hint_key != hint_checked_key:
+            hint = hint_solver.hint(current_level, state)
+            hint_checked_key = hint_key
+        elif hint is None:
+            hint = hint_solver.poll()
+        if hint is None and not hint_solver.failed:
+            scheduler.request_frame()
+    perf_overlay.lap('hint')
+    # The HUD panel only changes with the input mode, level, restart prompt or hint, and then the whole screen is redrawn.
+    hud_key = (input_mode, current_level, stuck, hints_on and hint_text())
+    if scheduler.exposed:
+        display.invalidate()
+    if hud_key != drawn_hud_key:
+        hud_panel = render_hud()
+        display.invalidate()
+        drawn_hud_key = hud_key
+    perf_overlay.lap('hud text')
+    dirty_rects = display.render_state(state)
+    perf_overlay.lap('render')
+    # The text is drawn over the level, so draw it again wherever the level was redrawn.
+    for rect in dirty_rects:
+        screen.blit(hud_panel, rect, rect)
+    perf_overlay.lap('hud')
 
     # Load next level if player has reached the goal
     if state.goal_reached():
         current_level += 1
-        if current_level <= len(level_loader.config['Levels']):
-            starting_state = level_loader.load_new_level_state(current_level)
-            state = deepcopy(starting_state)
-            history.forget_last_state()
+        if current_level <= level_loader.level_count():
+            starting_state = load_level(level_loader, current_level)
+            state = reset_level(starting_state)
+            forget_last_history_state()
         else:
             finished = True
             game_complete = True
         display.flash_green()
     # Put player back at the beginning and flash red if the player has fallen off
     elif state.player_fallen_off():
-        state = deepcopy(starting_state)
+        state = reset_level(starting_state)
         display.flash_red()
-
-    pygame.display.flip()
+    perf_overlay.lap('level')
+    if recorder is not None:
+        recorder.end_frame()
+    perf_overlay.lap('record')
+
+    perf_overlay_rect = perf_overlay.draw()
+    if perf_overlay_rect is not None:
+        dirty_rects.append(perf_overlay_rect)
+    perf_overlay.lap('overlay')
+    pygame.display.update(dirty_rects)
+    perf_overlay.lap('update')
+    perf_overlay.end_frame()
+    # Keep the frames coming while the flash plays out, otherwise wait for input.
+    if display.is_flashing():
+        scheduler.request_frame()
+
+if recorder is not None:
+    recorder.close()
+if hint_solver is not None:
+    hint_solver.close()
+if deadlock_solver is not None:
+    deadlock_solver.close()
+
+# Let the final flash finish before leaving the level behind.
+while display.is_flashing():
+    scheduler.tick()
+    pygame.display.update(display.render_state(state))
 
 if game_complete:
     finished = False
+    congratulations_drawn = False
+    scheduler.request_frame()
     while not finished:
-        for event in pygame.event.get():
+        for event in scheduler.get_events():
             if event.type == pygame.QUIT:
                 pygame.quit()
                 quit()
             elif event.type == pygame.MOUSEBUTTONDOWN or event.type == pygame.JOYBUTTONDOWN:
                 finished = True
+        if congratulations_drawn and not scheduler.exposed:
+            continue
+        congratulations_drawn = True
         screen.fill(BLACK)
-        game_name = h1_font.render('Congratulations!', 1, SILVER)
+        game_name = text_cache.render(h1_font, 'Congratulations!', SILVER)
         game_name_rect = game_name.get_rect()
         game_name_pos = (int(screen_width/2 - game_name_rect[2]/2), int(screen_height/2 - game_name_rect[3]*3))
         screen.blit(game_name, game_name_pos)
-        tagline = h2_font.render('You have finished the demo. Press any button to quit.', 1, LIGHT_GREY)
+        tagline = text_cache.render(h2_font, 'You have finished the demo. Press any button to quit.', LIGHT_GREY)
         tagline_rect = tagline.get_rect()
         tagline_pos = (int(screen_width/2 - tagline_rect[2]/2), int(screen_height/2 - game_name_rect[3]*2))
         screen.blit(tagline, tagline_pos)